@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+#
+# Benchmarks, runnable without a terminal.
+#
+#   python bench.py [suite] [--quick] [--json FILE] [--compare FILE]
+#       seeded per-subsystem suite: ops/sec and allocations for map
+#       creation, sprinkle, try_move sub-stepping, collisions, monster
+#       ticks (as objects and as a Population), flow field rebuilds with
+#       a lookup per monster, field of view casts, spawning in combat,
+#       object pruning, spatial queries, timers and rendering at several map
+#       sizes and monster densities.  --json writes the results,
+#       --compare checks them against an earlier --json file and exits
+#       with status 1 if anything got slower than --tolerance allows.
+#
+#   python bench.py sprinkle [size ...]
+#       world generation, batched sprinkle vs. the old per-cell path
+#
+#   python bench.py queries [size ...]
+#       spatial queries (Map.objects_in and friends) vs. scanning every
+#       object, at 1% and 5% monsters (10k and 50k objects at 1000^2)
+#
+#   python bench.py screen [size ...]
+#       cells and bytes sent per 80x24 frame by the Screen diff vs. a
+#       full redraw, with the player standing still and walking
+
+import sys
+import time
+import json
+import random
+import platform
+import argparse
+import tracemalloc
+
+from curse import Glyph, Tile, Map, Monster, Item, Screen, \
+    Alarm, TimerWheel, build_world, hud_render, view_render
+
+SEED = 1
+SIZES = [100, 300, 1000]
+DENSITIES = [0.01, 0.05]
+SPRINKLE_SIZES = [300, 1000, 3000]
+QUERY_SIZES = [1000, 2000]
+
+# per-cell generation, as Map.sprinkle_tile/sprinkle_object used to do it
+def percell_sprinkle_tile(world, glyph, freq, **kwargs):
+    tid = world.tile_id(Tile(glyph, **kwargs))
+    grid = world.grid
+    for i in range(len(grid)):
+        if world.random.random() <= freq:
+            grid[i] = tid
+
+def percell_sprinkle_object(world, factory, freq, **kwargs):
+    for i in range(int(freq * world.w * world.h)):
+        p = factory(**kwargs)
+        world.ensure_object(p)
+        # Object.random_teleport as it was: a random cell, nudged about
+        # until it is one p can stand on
+        while True:
+            rx = world.random.randint(0, world.w - 1)
+            ry = world.random.randint(0, world.h - 1)
+            t = world.tile(rx, ry)
+            done = False
+            for attempt in range(20):
+                if p.can_pass(t) and world.index(rx, ry) not in world.cells:
+                    done = True
+                    break
+                rx += world.random.randint(0, 2) - 1
+                ry += world.random.randint(0, 2) - 1
+                (rx, ry) = world.snap(rx, ry)
+                t = world.tile(rx, ry)
+            if done:
+                break
+        p.teleport(rx, ry)
+
+def generate(size, batched, seed=SEED):
+    grass = Glyph('grass', '.', 2, plural=True)
+    world = Map("bench", size, size, grass, seed=seed)
+    rock = world.glyph('rock', 'o', 4)
+    bush = world.glyph('bush', '*', 3)
+    tree = world.glyph('tree', 'T', 5)
+    monster = world.glyph('monster', 'M', 6)
+    gold = world.glyph('gold', '*', 7)
+    health = world.glyph('health', '+', 8)
+
+    if batched:
+        sprinkle_tile = world.sprinkle_tile
+        sprinkle_object = world.sprinkle_object
+    else:
+        sprinkle_tile = lambda *a, **kw: percell_sprinkle_tile(world, *a, **kw)
+        sprinkle_object = lambda *a, **kw: percell_sprinkle_object(world, *a, **kw)
+
+    sprinkle_tile(rock, 0.01, solid=True)
+    sprinkle_tile(bush, 0.02, conceal=True)
+    sprinkle_tile(tree, 0.02, solid=True)
+    sprinkle_object(
+        lambda **kwargs: Monster("monster", monster, world,
+            speed=world.random.random()*2.0, **kwargs),
+        0.01
+    )
+    sprinkle_object(lambda **kwargs: Item("gold coin", gold, world, **kwargs), 0.001)
+    sprinkle_object(lambda **kwargs: Item("health kit", health, world, **kwargs), 0.0001)
+    return world
+
+# in-memory curses window
+class FakeWindow:
+    def __init__(self, w=80, h=24):
+        self.size = (w, h)
+        self.calls = 0
+        self.bytes = 0
+
+    def getmaxyx(self):
+        return (self.size[1], self.size[0])
+
+    def addstr(self, y, x, string, color=0):
+        self.calls += 1
+        self.bytes += len(string)
+
+    def erase(self):
+        pass
+
+    def box(self):
+        pass
+
+    def refresh(self):
+        pass
+
+    def getch(self):
+        return -1
+
+# the forest with size x size cells and the given monster density
+def make_world(size, density=0.01, seed=SEED):
+    random.seed(seed)
+    sim = build_world(seed, size, size)
+    world = sim.world
+    if density > 0.01:
+        monster = world.glyph('monster')
+        world.sprinkle(
+            lambda **kwargs: Monster("monster", monster, world,
+                speed=world.random.random()*2.0, **kwargs),
+            density - 0.01
+        )
+    return sim
+
+def monsters(world):
+    return [obj for obj in world.objects if isinstance(obj, Monster)]
+
+# Each benchmark takes its parameters and returns (run, ops): run() does
+# one batch of work and ops is the number of operations in a batch.
+
+def bench_map_init(size, density):
+    grass = Glyph('grass', '.', 2, plural=True)
+    return (lambda: Map("bench", size, size, grass), 1)
+
+def bench_sprinkle(size, density):
+    def run():
+        make_world(size, density)
+    return (run, 1)
+
+def bench_try_move(size, density):
+    # fast float objects, swept through the cells on the way
+    sim = make_world(size, density)
+    world = sim.world
+    bullets = []
+    for i in range(200):
+        b = world.spawn("bullet", pos=(0.0, 0.0), vel=(20.0, 10.0))
+        bullets.append(b)
+    def run():
+        for b in bullets:
+            x = world.random.randint(0, size - 1)
+            y = world.random.randint(0, size - 1)
+            b.teleport(x * 1.0, y * 1.0)
+            b.try_move(20.0 / 15.0, 10.0 / 15.0)
+        del world.contacts[:] # no collision pass, keep the bullets alive
+    return (run, len(bullets))
+
+def bench_collisions(size, density):
+    # a monster stepping in and out of a crowded cell, with the collision
+    # pass after each entry
+    sim = make_world(size, density)
+    world = sim.world
+    gold = world.glyph('gold')
+    (x, y) = (size // 2, size // 2)
+    world.set_tile(x, y, world.tiles[0])
+    world.set_tile(x + 1, y, world.tiles[0])
+    for i in range(8):
+        Item("gold coin", gold, world, pos=(x, y)).attach()
+    m = Monster("monster", world.glyph('monster'), world, pos=(x + 1, y))
+    m.attach()
+    def run():
+        for i in range(50):
+            m.try_move(-1, 0)
+            world.collide()
+            m.try_move(1, 0)
+    return (run, 100)
+
+def bench_monster_tick(size, density):
+    sim = make_world(size, density)
+    objs = monsters(sim.world)
+    def run():
+        for obj in objs:
+            obj.tick(1.0 / 15.0)
+    return (run, len(objs))
+
+def bench_flow_field(size, density):
+    # the flow field rebuilt as the player steps back and forth, and a
+    # lookup for every monster
+    sim = make_world(size, density)
+    world = sim.world
+    player = sim.player
+    (x, y) = (player.x, player.y)
+    objs = monsters(world)
+    def run():
+        for dx in (0, 1):
+            player.teleport(x + dx, y)
+            world.flow_field.update()
+            for obj in objs:
+                world.flow_step(obj.x, obj.y)
+    return (run, 2)
+
+def bench_fov(size, density):
+    # the player's field of view after a step (not cached), and then
+    # asked again from the same cell (cached)
+    sim = make_world(size, density)
+    player = sim.player
+    fov = sim.world.fov
+    def run():
+        for dx in (0, 1):
+            fov.cache.clear()
+            fov.visible(player.x + dx, player.y, player.sight)
+            fov.visible(player.x + dx, player.y, player.sight)
+    return (run, 2)
+
+def bench_population_step(size, density):
+    # the same monsters, kept in a Population
+    random.seed(SEED)
+    sim = build_world(SEED, size, size, population=True)
+    world = sim.world
+    pop = world.populations[0]
+    if density > 0.01:
+        pop.sprinkle(density - 0.01, lambda: world.random.random()*2.0)
+    def run():
+        pop.step(1.0 / 15.0)
+    return (run, len(pop))
+
+def bench_combat(size, density):
+    # the player swinging and shooting every frame, spawned objects come
+    # from the pools once the first ones are pruned
+    sim = make_world(size, density)
+    sim.player.hp = 10 ** 9
+    def run():
+        for cmd in ('swing', 'shoot', 'left', 'swing', 'shoot', 'right'):
+            sim.step(1.0 / 15.0, [cmd])
+    return (run, 4)
+
+def bench_prune(size, density):
+    # detach a tenth of the objects, prune, and put them back
+    sim = make_world(size, density)
+    world = sim.world
+    objs = monsters(world)[::10]
+    def run():
+        for obj in objs:
+            obj.detach()
+        world.prune()
+        for obj in objs:
+            world.ensure_object(obj)
+            obj.attach()
+    return (run, len(world.objects))
+
+def bench_queries(size, density):
+    # what a player could ask about its surroundings: the objects in its
+    # view, the monsters within hunting distance, the nearest gold coin
+    # and the nearest free cell
+    sim = make_world(size, density)
+    world = sim.world
+    player = sim.player
+    (x, y) = (player.x, player.y)
+    def run():
+        world.objects_in(x - 30, y - 10, x + 30, y + 10)
+        world.objects_near(x, y, 10, Monster)
+        world.nearest(x, y, "gold coin")
+        world.nearest_free(x, y, player, 8)
+    return (run, 4)
+
+def bench_timers(size, density):
+    # an alarm pending per cell at the monster density, a frame of
+    # simulation time advanced per op; the alarms that go off are
+    # scheduled again, so as many stay pending
+    timers = TimerWheel()
+    now = [0.0]
+    def alarm():
+        a = Alarm(random.uniform(0.1, 30.0))
+        a.signal += lambda: timers.add(a, now[0])
+        return a
+    for i in range(int(size * size * density)):
+        timers.add(alarm(), 0.0)
+    def run():
+        now[0] += 1.0 / 60.0
+        timers.advance(now[0])
+    return (run, 1)
+
+def bench_render(size, density):
+    # 80x24 frames (map view, HUD and diffed flush), the camera moving
+    # back and forth by one cell so that most of the view changes
+    sim = make_world(size, density)
+    world = sim.world
+    player = sim.player
+    screen = Screen()
+    win = FakeWindow()
+    def run():
+        for dx in (0, 1):
+            screen.begin(win)
+            camera = [player.x - 30 + dx, player.y - 10]
+            world.render(screen, camera, [10, 2, 60, 20])
+            hud_render(screen, player)
+            screen.flush(win)
+    return (run, 2)
+
+BENCHMARKS = [
+    ("map_init", bench_map_init),
+    ("sprinkle", bench_sprinkle),
+    ("try_move", bench_try_move),
+    ("collisions", bench_collisions),
+    ("monster_tick", bench_monster_tick),
+    ("flow_field", bench_flow_field),
+    ("fov", bench_fov),
+    ("population", bench_population_step),
+    ("combat", bench_combat),
+    ("prune", bench_prune),
+    ("queries", bench_queries),
+    ("timers", bench_timers),
+    ("render", bench_render),
+]
+
+def measure(name, fn, size, density, min_time):
+    random.seed(SEED)
+    (run, ops) = fn(size, density)
+
+    # allocations of one batch, measured separately as tracing is slow
+    tracemalloc.start()
+    (start, _) = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    run()
+    (end, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    batches = 0
+    elapsed = 0.0
+    while elapsed < min_time:
+        t0 = time.perf_counter()
+        run()
+        elapsed += time.perf_counter() - t0
+        batches += 1
+    return {
+        "name": name,
+        "size": size,
+        "density": density,
+        "ops_per_sec": batches * ops / elapsed,
+        "alloc_peak_bytes": peak - start,
+        "alloc_retained_bytes": end - start,
+    }
+
+def key(r):
+    return "%s/%d/%g" % (r["name"], r["size"], r["density"])
+
+def suite(args):
+    sizes = SIZES[:2] if args.quick else SIZES
+    min_time = 0.05 if args.quick else 0.3
+    results = []
+    print("%-14s %6s %8s %14s %12s %12s" % (
+        "benchmark", "size", "density", "ops/sec", "peak KiB", "kept KiB"))
+    for (name, fn) in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        for size in sizes:
+            for density in DENSITIES:
+                r = measure(name, fn, size, density, min_time)
+                results.append(r)
+                print("%-14s %6d %8g %14.1f %12.1f %12.1f" % (
+                    name, size, density, r["ops_per_sec"],
+                    r["alloc_peak_bytes"] / 1024.0,
+                    r["alloc_retained_bytes"] / 1024.0))
+
+    doc = {
+        "seed": SEED,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(doc, f, indent=1)
+
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            old = dict((key(r), r) for r in json.load(f)["results"])
+        print("\ncompared with %s:" % args.compare)
+        for r in results:
+            o = old.get(key(r))
+            if not o:
+                continue
+            ratio = r["ops_per_sec"] / o["ops_per_sec"]
+            flag = ""
+            if ratio < 1.0 - args.tolerance:
+                flag = "  REGRESSION"
+                status = 1
+            print("%-28s %7.2fx%s" % (key(r), ratio, flag))
+    return status
+
+def timed(fn, *args):
+    t0 = time.perf_counter()
+    r = fn(*args)
+    return (time.perf_counter() - t0, r)
+
+def sprinkle(args):
+    sizes = args.sizes or SPRINKLE_SIZES
+    print("%8s %12s %12s %8s" % ("size", "per-cell s", "batched s", "speedup"))
+    for size in sizes:
+        (slow, _) = timed(generate, size, False)
+        (fast, world) = timed(generate, size, True)
+        print("%8s %12.3f %12.3f %7.1fx" % ("%d^2" % size, slow, fast, slow / fast))
+        # same seed, same world
+        assert generate(size, True).grid == world.grid
+    return 0
+
+# the spatial queries as scans of every object
+def scan_in(objs, x0, y0, x1, y1):
+    return [obj for obj in objs if x0 <= int(round(obj.x)) <= x1 and
+        y0 <= int(round(obj.y)) <= y1]
+
+def scan_near(objs, x, y, radius, cls):
+    r = [((obj.x - x) ** 2 + (obj.y - y) ** 2, obj) for obj in objs
+        if isinstance(obj, cls)]
+    r = [e for e in r if e[0] <= radius * radius]
+    r.sort(key=lambda e: e[0])
+    return [obj for (d, obj) in r]
+
+def scan_nearest(objs, x, y, name):
+    r = [((obj.x - x) ** 2 + (obj.y - y) ** 2, obj) for obj in objs
+        if obj.name == name]
+    return min(r, key=lambda e: e[0])[1] if r else None
+
+# microseconds per call of fn(*args), and its result
+def per_call(fn, *args):
+    n = 0
+    t0 = time.perf_counter()
+    while n < 3 or time.perf_counter() - t0 < 0.2:
+        r = fn(*args)
+        n += 1
+    return ((time.perf_counter() - t0) / n * 1e6, r)
+
+def queries(args):
+    print("%8s %8s %8s %-12s %12s %12s %9s" % ("size", "density",
+        "objects", "query", "scan us", "index us", "speedup"))
+    for size in args.sizes or QUERY_SIZES:
+        for density in DENSITIES:
+            sim = make_world(size, density)
+            world = sim.world
+            objs = [obj for obj in world.objects if obj.attached()]
+            objs.append(sim.player)
+            (x, y) = (sim.player.x, sim.player.y)
+            cases = [
+                ("rect 61x21", (scan_in, objs, x - 30, y - 10, x + 30, y + 10),
+                    (world.objects_in, x - 30, y - 10, x + 30, y + 10)),
+                ("near 10", (scan_near, objs, x, y, 10, Monster),
+                    (world.objects_near, x, y, 10, Monster)),
+                ("nearest", (scan_nearest, objs, x, y, "gold coin"),
+                    (world.nearest, x, y, "gold coin")),
+            ]
+            for (name, scan, index) in cases:
+                (slow, expected) = per_call(*scan)
+                (fast, result) = per_call(*index)
+                # same answers (nearest may tie)
+                if name == "nearest":
+                    assert (result.x - x) ** 2 + (result.y - y) ** 2 == \
+                        (expected.x - x) ** 2 + (expected.y - y) ** 2
+                else:
+                    assert set(result) == set(expected)
+                print("%8s %8g %8d %-12s %12.1f %12.1f %8.0fx" % (
+                    "%d^2" % size, density, len(objs), name, slow, fast,
+                    slow / fast))
+    return 0
+
+# cells, bytes and writes per frame sent by the diff, and cells and bytes
+# of a full redraw, over frames steps of sim (the player walking if walk)
+def screen_frames(sim, frames, walk):
+    screen = Screen()
+    win = FakeWindow()
+    totals = [0, 0, 0, 0, 0]
+    for i in range(frames):
+        sim.step(1.0 / 15.0, [("left", "up")[i % 2]] if walk else [])
+        if sim.over():
+            sim.command("respawn")
+        screen.begin(win)
+        view_render(screen, sim.player)
+        hud_render(screen, sim.player)
+        screen.flush(win)
+        if i == 0:
+            continue # the first frame is drawn in full either way
+        for (j, n) in enumerate((screen.cells, screen.bytes, screen.writes) +
+                screen.redraw_cost()):
+            totals[j] += n
+    return [n / float(frames - 1) for n in totals]
+
+def screen(args):
+    sizes = args.sizes or SIZES
+    print("%8s %-8s %12s %12s %10s %12s %12s" % ("size", "player",
+        "full cells", "diff cells", "full B", "diff B", "diff writes"))
+    for size in sizes:
+        for walk in (False, True):
+            (cells, bytes_, writes, full_cells, full_bytes) = \
+                screen_frames(make_world(size), 100, walk)
+            print("%8s %-8s %12.0f %12.1f %10.0f %12.1f %12.1f" % (
+                "%d^2" % size, ("idle", "walking")[walk], full_cells, cells,
+                full_bytes, bytes_, writes))
+    return 0
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command")
+    p = sub.add_parser("suite")
+    p.add_argument("--quick", action="store_true")
+    p.add_argument("--only", nargs="*")
+    p.add_argument("--json")
+    p.add_argument("--compare")
+    p.add_argument("--tolerance", type=float, default=0.25)
+    p = sub.add_parser("sprinkle")
+    p.add_argument("sizes", type=int, nargs="*")
+    p = sub.add_parser("queries")
+    p.add_argument("sizes", type=int, nargs="*")
+    p = sub.add_parser("screen")
+    p.add_argument("sizes", type=int, nargs="*")
+
+    if argv[:1] not in (["suite"], ["sprinkle"], ["queries"], ["screen"],
+            ["-h"], ["--help"]):
+        argv = ["suite"] + argv
+    args = parser.parse_args(argv)
+    if args.command == "sprinkle":
+        return sprinkle(args)
+    if args.command == "queries":
+        return queries(args)
+    if args.command == "screen":
+        return screen(args)
+    return suite(args)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,12 +1,25 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
-import curses
+import sys
 import time
 import random
-import copy
-import time
 import itertools
-import euclid
+import array
+import math
+import json
+import collections
+import os
+import struct
+import hashlib
+import mmap
+import threading
+import weakref
+import argparse
+
+try:
+    import curses
+except ImportError: # headless use, or Windows without curses installed
+    curses = None
 
 random.seed()
 
@@ -16,44 +29,75 @@ def log(msg):
     global msgs
     msgs.append(msg)
 
+# attribute for color pair n.  Falls back to the usual encoding when curses
+# isn't initialized (or missing), so rendering works headless too.
+def color_pair(n):
+    if curses:
+        try:
+            return curses.color_pair(n)
+        except curses.error:
+            pass
+    return n << 8
+
 class Glyph:
+    __slots__ = ("name", "string", "pair", "_color", "plural")
+
     def __init__(self,name,string,color,**kwargs):
         self.name = name
         self.string = string
-        self.color = curses.color_pair(color)
+        self.pair = color
+        self._color = None
         self.plural = kwargs.get("plural", False)
 
+    # looked up on first use, so glyphs can be made before curses is
+    # initialized
+    @property
+    def color(self):
+        if self._color is None:
+            self._color = color_pair(self.pair)
+        return self._color
+
 def draw(win, glyph, x, y):
     win.addstr(y, x, glyph.string, glyph.color)
 
 class Signal:
+    # the slot list is only made once something connects
+    __slots__ = ("slots",)
     def __init__(self):
-        self.slots = []
+        self.slots = None
     def __call__(self, *args):
-        for slot in self.slots:
+        for slot in self.slots or ():
             slot(*args)
     def __iadd__(self, cb):
-        self.slots += [cb]
+        self.slots = (self.slots or []) + [cb]
         return self
 
 class Alarm:
+    __slots__ = ("time", "length", "signal", "done", "repeat", "due", "slot")
 
     # length: float value in seconds
     # event (opt): elapse callback (or list of)
-    def __init__(self, length, event=None):
+    # repeat (opt): when scheduled on a TimerWheel, go off every length
+    #   seconds until cancelled
+    def __init__(self, length, event=None, repeat=False):
         self.time = 0
         self.length = length
         
         self.signal = Signal()
 
         self.done = False
+        self.repeat = repeat
+
+        # the wheel tick it is due at, and the wheel slot it is in
+        self.due = None
+        self.slot = None
 
         if event:
             if type(event) == type([]):
                 for ev in event:
                     self.signal += ev
             else:
-                self.signal += ev
+                self.signal += event
     
     def elapsed(self):
         return self.done
@@ -67,7 +111,294 @@ class Alarm:
                 self.done = True
         return self.done
 
+    # don't go off (again), also taking it off its TimerWheel
+    def cancel(self):
+        self.done = True
+        if self.slot is not None:
+            del self.slot[self]
+            self.slot = None
+
+class TimerWheel:
+    # Alarms going off at simulation times, in a hierarchical timing
+    # wheel: LEVELS wheels of SLOTS slots, a slot of the first one lasting
+    # resolution seconds and a slot of each of the others as long as a
+    # whole turn of the one below.  An alarm waits in the lowest wheel
+    # whose current turn it is due in, and is moved down a level (a
+    # cascade) when the wheel above gets to its slot.  Adding, cancelling
+    # and firing an alarm cost O(1), and a tick only looks at its own slot
+    # (and, once per turn, a slot of the wheel above), however many alarms
+    # are pending.  Slots are dicts used as ordered sets, so alarms due at
+    # the same tick go off in the order they were added.
+    SLOTS = 256
+    LEVELS = 4
+    BITS = 8 # log2(SLOTS)
+
+    def __init__(self, resolution=1.0 / 60.0):
+        self.resolution = resolution
+        self.tick = 0 # alarms due up to this tick went off
+        self.wheels = [[{} for i in range(self.SLOTS)]
+            for level in range(self.LEVELS)]
+        self.fired = 0
+
+    # schedule alarm to go off alarm.length seconds (or first, if given)
+    # after now (simulation time, at least one tick after the last
+    # advance())
+    def add(self, alarm, now, first=None):
+        alarm.done = False
+        if first is None:
+            first = alarm.length
+        due = int(math.ceil((now + first) / self.resolution - 1e-9))
+        alarm.due = max(due, self.tick + 1)
+        self.insert(alarm)
+        return alarm
+
+    def insert(self, alarm):
+        (due, tick, bits) = (alarm.due, self.tick, self.BITS)
+        level = 0
+        while level < self.LEVELS - 1 and \
+                due >> (bits * (level + 1)) != tick >> (bits * (level + 1)):
+            level += 1
+        slot = self.wheels[level][(due >> (bits * level)) % self.SLOTS]
+        slot[alarm] = None
+        alarm.slot = slot
+
+    # fire the alarms due by simulation time now
+    def advance(self, now):
+        target = int(now / self.resolution + 1e-9)
+        (bits, mask) = (self.BITS, self.SLOTS - 1)
+        while self.tick < target:
+            self.tick += 1
+            tick = self.tick
+            # the wheels above that start a new slot, from the top down
+            level = 0
+            while level < self.LEVELS - 1 and \
+                    (tick >> (bits * level)) & mask == 0:
+                level += 1
+            for l in range(level, 0, -1):
+                slot = self.wheels[l][(tick >> (bits * l)) & mask]
+                if slot:
+                    alarms = list(slot)
+                    slot.clear()
+                    for alarm in alarms:
+                        self.insert(alarm)
+            slot = self.wheels[0][tick & mask]
+            if slot:
+                alarms = list(slot)
+                slot.clear()
+                # all off the wheel before any goes off, as one may cancel
+                # (or add again) another; those are skipped
+                for alarm in alarms:
+                    alarm.slot = None
+                for alarm in alarms:
+                    if not alarm.done and alarm.slot is None:
+                        self.fire(alarm)
+
+    def fire(self, alarm):
+        self.fired += 1
+        if alarm.repeat:
+            alarm.due += max(1, int(math.ceil(alarm.length /
+                self.resolution - 1e-9)))
+            self.insert(alarm)
+        else:
+            alarm.done = True
+        alarm.signal()
+
+    # number of alarms waiting
+    def pending(self):
+        return sum(len(slot) for wheel in self.wheels for slot in wheel)
+
+# Event handlers, by event name and class.  handler(obj, *args) is called
+# for every event emitted (see EventBus.emit) on an instance of the class,
+# or of a subclass; handlers of base classes run first.
+event_handlers = {}
+event_cache = {} # (event, type) -> handlers, see handlers_for()
+
+def handles(event, cls):
+    def register(handler):
+        event_handlers.setdefault((event, cls), []).append(handler)
+        event_cache.clear()
+        return handler
+    return register
+
+def handlers_for(event, T):
+    try:
+        return event_cache[(event, T)]
+    except KeyError:
+        pass
+    handlers = []
+    for cls in reversed(T.__mro__):
+        handlers.extend(event_handlers.get((event, cls), ()))
+    handlers = event_cache[(event, T)] = tuple(handlers)
+    return handlers
+
+class EventBus:
+    # A world's events: emit() dispatches through the handler tables above
+    # (nothing is stored on the objects), defer() queues an action on an
+    # object until drain(), once per tick.  Queued objects are held weakly,
+    # so an object dropped meanwhile is skipped rather than kept alive.
+    # counts has the number of each event emitted, for metrics, plus
+    # "deferred" and "expired" (deferred actions whose object was gone).
+    def __init__(self):
+        self.queue = [] # (weak reference, action), reused
+        self.counts = {}
+
+    def emit(self, event, obj, *args):
+        self.counts[event] = self.counts.get(event, 0) + 1
+        for handler in handlers_for(event, type(obj)):
+            handler(obj, *args)
+
+    # call action(obj) at the next drain()
+    def defer(self, obj, action):
+        self.queue.append((weakref.ref(obj), action))
+
+    def drain(self):
+        queue = self.queue
+        if not queue:
+            return
+        i = 0
+        while i < len(queue): # actions may defer more
+            (ref, action) = queue[i]
+            obj = ref()
+            if obj is None:
+                self.counts["expired"] = self.counts.get("expired", 0) + 1
+            else:
+                action(obj)
+            i += 1
+        self.counts["deferred"] = self.counts.get("deferred", 0) + i
+        del queue[:]
+
+class Profiler:
+    # Frame timings by phase (input, render, tick, ...), kept for the last
+    # `window` frames to give rolling percentiles, plus dropped frames
+    # (over budget seconds) and the tick cost of each object class.
+    # Every call returns at once while disabled, so it can stay in place.
+    def __init__(self, budget=1.0/15.0, window=300):
+        self.enabled = False
+        self.budget = budget
+        self.window = window
+        self.path = "profile.json" # where dump() writes by default
+        self.reset()
+
+    def reset(self):
+        self.phases = {}  # phase -> recent durations in seconds
+        self.classes = {} # object class name -> [ticks, seconds]
+        # what recent Screen.flush()es sent, and what full redraws would
+        # have: (cells, bytes, writes, full cells, full bytes)
+        self.screen = collections.deque(maxlen=self.window)
+        self.frames = 0
+        self.dropped = 0
+        self.start = self.last = 0.0
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        if self.enabled:
+            self.reset()
+
+    # call at the start of a frame
+    def begin(self):
+        if not self.enabled:
+            return
+        self.start = self.last = time.perf_counter()
+
+    # the time since the previous mark (or begin) was spent in phase
+    def mark(self, phase):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.sample(phase, now - self.last)
+        self.last = now
+
+    # call at the end of a frame
+    def end(self):
+        if not self.enabled:
+            return
+        t = time.perf_counter() - self.start
+        self.sample("frame", t)
+        self.frames += 1
+        if t > self.budget:
+            self.dropped += 1
+
+    def sample(self, phase, t):
+        d = self.phases.get(phase)
+        if d is None:
+            d = self.phases[phase] = collections.deque(maxlen=self.window)
+        d.append(t)
+
+    # call after screen.flush()
+    def flushed(self, screen):
+        if not self.enabled:
+            return
+        self.screen.append((screen.cells, screen.bytes, screen.writes) +
+            screen.redraw_cost())
+
+    # means of the screen stats, as in self.screen
+    def screen_means(self):
+        n = max(len(self.screen), 1)
+        return [sum(s[i] for s in self.screen) / float(n) for i in range(5)]
+
+    def tick_cost(self, name, t):
+        c = self.classes.get(name)
+        if c is None:
+            c = self.classes[name] = [0, 0.0]
+        c[0] += 1
+        c[1] += t
+
+    # p-th percentile (0-100) of the recent durations of phase, in seconds
+    def percentile(self, phase, p):
+        d = sorted(self.phases.get(phase, ()))
+        if not d:
+            return 0.0
+        return d[min(len(d) - 1, int(len(d) * p / 100.0))]
+
+    def report(self):
+        return {
+            "frames": self.frames,
+            "dropped": self.dropped,
+            "budget": self.budget,
+            "phases": dict((phase, {
+                "p50": self.percentile(phase, 50),
+                "p99": self.percentile(phase, 99),
+                "max": max(d),
+                "samples": len(d),
+            }) for (phase, d) in self.phases.items()),
+            "classes": dict((name, {
+                "ticks": c[0],
+                "seconds": c[1],
+                "mean": c[1] / c[0],
+            }) for (name, c) in self.classes.items()),
+            "screen": dict(zip(("cells", "bytes", "writes", "full_cells",
+                "full_bytes"), self.screen_means())),
+        }
+
+    def dump(self, path=None):
+        with open(path or self.path, "w") as f:
+            json.dump(self.report(), f, indent=1, sort_keys=True)
+
+    # text for the overlay, times in milliseconds
+    def lines(self):
+        r = ["%d frames, %d dropped" % (self.frames, self.dropped)]
+        for phase in sorted(self.phases):
+            r.append("%-7s p50 %6.2f p99 %6.2f" % (phase,
+                self.percentile(phase, 50) * 1000.0,
+                self.percentile(phase, 99) * 1000.0))
+        for (name, c) in sorted(self.classes.items()):
+            r.append("%-7s %5.1fus x%d" % (name[:7], c[1] / c[0] * 1e6, c[0]))
+        if self.screen:
+            (cells, bytes_, writes, full_cells, full_bytes) = \
+                self.screen_means()
+            r.append("screen  %.0f/%.0f cells %.0f/%.0f B %.0f writes" % (
+                cells, full_cells, bytes_, full_bytes, writes))
+        return r
+
 class Object(object):
+    # Objects are many, so they have no __dict__: every class lists its
+    # own attributes in __slots__.  Per-kind properties (plural, obvious,
+    # sight...) are class attributes, shared by all instances.
+    __slots__ = ("name", "glyph", "world", "cell_index", "pool", "x", "y",
+        "vx", "vy", "__weakref__")
+    plural = False
+    obvious = False
+
     def __init__(self, name, glyph, world, **kwargs):
         assert name
         self.name = name
@@ -75,11 +406,10 @@ class Object(object):
         self.glyph = glyph
         assert world
         self.world = world
+        self.cell_index = None # grid index of the cell we're attached to
+        self.pool = None # free list we go back to once pruned, see Map.spawn
         self.properties(**kwargs)
 
-        self.on_try_move = Signal()
-        self.on_collision = Signal()
-
     def draw(self, win):
         draw(win, self.glyph, self.x, self.y)
         
@@ -93,36 +423,31 @@ class Object(object):
             return (int(round(self.x), int(round(self.y))))
         
     def properties(self, **kwargs):
-        self.plural = kwargs.get("plural", False)
-        self.obvious = kwargs.get("obvious", False)
-        
         if "pos" in kwargs:
             (self.x, self.y) = kwargs["pos"]
         else:
             self.x = kwargs.get("x", 0)
             self.y = kwargs.get("y", 0)
         
-        (self.vx, self.vy) = kwargs.get("vel", (0,0))
-        self.vx *= 1.0
-        self.vy *= 1.0
+        (vx, vy) = kwargs.get("vel", (0,0))
+        # most objects stand still, and share the one 0.0
+        self.vx = vx * 1.0 if vx else 0.0
+        self.vy = vy * 1.0 if vy else 0.0
+
+    # called on a recycled object instead of __init__, see Map.spawn.
+    # subclasses with more state than properties() should override this
+    def reset(self, **kwargs):
+        self.properties(**kwargs)
 
     def attach(self):
-        tile = self.world.tile(self.x,self.y)
-        if tile and not self in tile.objects:
-            tile.objects.append(self)
+        self.world.enter(self)
         
     def detach(self):
-        tile = self.world.tile(self.x,self.y)
-        if tile and self in tile.objects:
-            tile.objects.remove(self)
+        if self.world.leave(self):
+            self.world.removed.append(self)
 
     def attached(self):
-        if not self.world:
-            return False
-        tile = self.world.tile(self.x,self.y)
-        if not tile:
-            return False
-        return self in tile.objects
+        return self.cell_index is not None
 
     def tick(self, t):
         pass
@@ -138,10 +463,7 @@ class Object(object):
         
     def move(self, x, y):
         assert self.attached()
-        self.detach()
-        self.x += x
-        self.y += y
-        self.attach()
+        self.world.place(self, self.x + x, self.y + y)
         
     def try_move(self, x, y):
         if not self.attached():
@@ -149,72 +471,49 @@ class Object(object):
 
         result = False
         
-        # move incrementally to prevent tunneling
+        # sweep through every cell on the way to prevent tunneling
         if isinstance(self.x, float):
-            while True:
-                d = euclid.Vector2(x,y)
-                if d.magnitude() <= 1.0:
-                    break
-                d.normalize()
-                result = self.try_move(d.x, d.y)
-                if not result:
-                    return result
-                (x,y) = (x - d.x, y - d.y)
-
-        if not self.attached():
-            return False
+            return self.sweep_move(x, y)
         
         target = self.immediate_tile(x, y)
         if target and self.can_pass(target):
-            self.detach()
-            self.x += x
-            self.y += y
-            self.attach()
+            # entering a cell makes contact with whatever is there, the
+            # collisions are resolved by Map.collide()
+            if self.world.place(self, self.x + x, self.y + y):
+                self.world.contact(self, self.x, self.y)
             result = True
 
-        self.on_try_move(x, y, result)
-
-        # target can be null here, even if result is True
-        if target and result and len(target.objects) > 1:
-            post_signal = Signal()
-            obj_list = target.objects
-            for p in itertools.combinations(obj_list, 2):
-                p[0].on_collision(p[1], post_signal)
-                p[1].on_collision(p[0], post_signal)
-            post_signal()
+        self.world.events.emit("try_move", self, x, y, result)
 
         return result
     
+    # try_move for float positions: walks the grid cells along the way
+    # (Map.sweep) and stops short of the first one we can't pass.  Makes
+    # contact with everything in the cells crossed.
+    def sweep_move(self, x, y):
+        world = self.world
+        (cells, t) = world.sweep(self.x, self.y, x, y, self.can_pass)
+        for (cx, cy) in cells:
+            world.contact(self, cx, cy)
+        world.place(self, self.x + x * t, self.y + y * t)
+        result = t == 1.0
+
+        self.world.events.emit("try_move", self, x, y, result)
+
+        return result
+
     def teleport(self, x, y):
-        self.detach()
-        self.x = x
-        self.y = y
-        self.attach()
+        self.world.place(self, x, y)
 
     def random_teleport(self):
-        done = False
         use_floats = isinstance(self.x, float)
         while True:
-            # pick a random tile
-            rx = random.randint(0, self.world.w - 1)
-            ry = random.randint(0, self.world.h - 1)
-            t = self.world.tile(rx, ry)
-            assert t
-            
-            # attempt to nudge it a few times into a non-solid area
-            attempts = 0
-            while attempts < 20:
-                if self.can_pass(t) and not t.objects:
-                    done = True
-                    break
-                
-                rx += random.randint(0,2)-1
-                ry += random.randint(0,2)-1
-                (rx, ry) = self.world.snap(rx, ry)
-                t = self.world.tile(rx, ry)
-                attempts += 1
-            
-            if done:
+            # pick a random tile, then the nearest one we can stand on
+            rx = self.world.random.randint(0, self.world.w - 1)
+            ry = self.world.random.randint(0, self.world.h - 1)
+            free = self.world.nearest_free(rx, ry, self, 4)
+            if free:
+                (rx, ry) = free
                 break
         
         if use_floats:
@@ -232,30 +531,24 @@ class Object(object):
         return self.world.tile(self.x + x,self.y + y)
         
 class Player(Object):
+    __slots__ = ("hp", "dir", "last_target", "gold", "last_pickup")
+    sight = 30 # how far we see, in cells
+
+    # direction -> name of the glyph facing it, shared by all players
+    turns = {
+        (1,0): 'player_right',
+        (-1,0): 'player_left',
+        (0,-1): 'player_up',
+        (0,1): 'player',
+    }
+
     def __init__(self, name, glyph, world, **kwargs):
         super(self.__class__, self).__init__(name, glyph, world, **kwargs)
         self.hp = 100
-        self.on_try_move += self.orient
-        self.on_collision += self.collision
         self.dir = [0,1]
         self.last_target = ""
         self.gold = 0
         self.last_pickup = ""
-        self.obvious = False
-
-    def collision(self, other, post_signal):
-        if other.__class__.__name__ == 'Monster':
-            self.hp = max(0, self.hp - 25)
-        elif other.__class__.__name__ == 'Item':
-            if other.name == 'gold coin':
-                self.gold += 10
-                self.last_pickup = other.name
-                post_signal += lambda: other.detach()
-            elif other.name == 'health kit':
-                #self.hp += min(self.hp + 25, 100)
-                self.hp = 100
-                self.last_pickup = other.name
-                post_signal += lambda: other.detach()
 
     def thinking(self):
         if self.hiding():
@@ -272,23 +565,61 @@ class Player(Object):
         target = ""
         if tile:
             objs = list(filter(lambda o: not o.obvious, tile.objects))
+            pop = self.world.population_at(self.x + self.dir[0],
+                self.y + self.dir[1])
             if objs:
                 target = self.last_target = \
                     ("" if objs[0].plural else "a ") + \
                     objs[0].name
+            elif pop:
+                target = self.last_target = "a " + pop.name
             elif not tile.obvious:
                 target = self.last_target = \
                     ("" if tile.plural else "a ") + \
                     tile.name
+            else:
+                target = self.sight_target()
         if target:
             self.last_pickup = None # clear pickup messages
         else:
             self.last_target = ""
 
+    # name of the first thing further ahead in line of sight, if any.
+    # Straight ahead (along an axis) a cell is in sight exactly when none
+    # of the cells before it blocks the view, as FieldOfView casts it.
+    def sight_target(self):
+        (dx, dy) = self.dir
+        ahead = self.world.tile(self.x + dx, self.y + dy)
+        if not ahead or ahead.solid or ahead.conceal:
+            return ""
+        for k in range(2, self.sight + 1):
+            (x, y) = (self.x + dx * k, self.y + dy * k)
+            tile = self.world.tile(x, y)
+            if not tile:
+                break
+            for obj in tile.objects:
+                if not obj.obvious:
+                    self.last_target = ("" if obj.plural else "a ") + obj.name
+                    return self.last_target
+            pop = self.world.population_at(x, y)
+            if pop:
+                self.last_target = "a " + pop.name
+                return self.last_target
+            if tile.solid or tile.conceal:
+                break
+        return ""
+
     def hiding(self):
         t = self.current_tile()
         return t and t.conceal
 
+    # back to full health somewhere else, with nothing
+    def respawn(self):
+        self.detach()
+        self.hp = 100
+        self.gold = 0
+        self.random_teleport()
+
     def swing(self):
         speed = 20.0
         # sword swing travels 90deg clockwise player dir
@@ -315,14 +646,11 @@ class Player(Object):
         )
     
     def orient(self, x, y, result):
-        if x > 0:
-            self.glyph.string = '>'
-        elif x < 0:
-            self.glyph.string = '<'
-        elif y < 0:
-            self.glyph.string = '^'
-        elif y > 0:
-            self.glyph.string = 'v'
+        if x:
+            self.glyph = self.world.glyph(self.turns[(1 if x > 0 else -1, 0)])
+        elif y:
+            self.glyph = self.world.glyph(self.turns[(0, 1 if y > 0 else -1)])
+        self.world.redraw(self)
 
         self.dir = [x, y]
 
@@ -330,47 +658,71 @@ class Player(Object):
         self.update_targets()
 
 class Sword(Object):
+    __slots__ = ("speed", "dir", "frame", "alarm")
+    obvious = True
+
+    # direction -> animation glyph sequence, shared by all swords
+    animation = {
+        #(0,1): ['\\', '|', '/'],
+        #(-1,0): ['/', '-', '\\'],
+        #(0,-1): ['\\', '|', '/'],
+        #(1,0): ['/', '-', '\\']
+        
+        (-1,0): ['\\', '|', '/'],
+        (0,-1): ['/', '-', '\\'],
+        (1,0): ['\\', '|', '/'],
+        (0,1): ['/', '-', '\\']
+    }
+    # we use tuples since they can be dict keys
+
     def __init__(self, name, glyph, world, **kwargs):
         super(self.__class__, self).__init__(name, glyph, world, **kwargs)
-        self.obvious = True
-        self.on_collision += self.collision
+        self.swing()
+
+    def reset(self, **kwargs):
+        super(self.__class__, self).reset(**kwargs)
+        self.alarm.cancel() # of the last swing
+        self.swing()
+        self.glyph = self.world.glyph(self.animation[tuple(self.dir)][0])
+        self.world.redraw(self)
 
+    # start the swing along our velocity, a frame every cell travelled
+    def swing(self):
         # get direction from normalized velocity
-        dir = euclid.Vector2(self.vx, self.vy)
-        self.speed = dir.magnitude()
-        dir.normalize()
-        self.dir = [int(round(dir.x)), int(round((dir.y)))]
-        
-        # direction -> animation glyph sequence
-        self.animation = {
-            #(0,1): ['\\', '|', '/'],
-            #(-1,0): ['/', '-', '\\'],
-            #(0,-1): ['\\', '|', '/'],
-            #(1,0): ['/', '-', '\\']
-            
-            (-1,0): ['\\', '|', '/'],
-            (0,-1): ['/', '-', '\\'],
-            (1,0): ['\\', '|', '/'],
-            (0,1): ['/', '-', '\\']
-        }
-        # we use tuples since they can be dict keys
+        self.speed = math.hypot(self.vx, self.vy)
+        self.dir = [int(round(self.vx / self.speed)), int(round(self.vy / self.speed))]
         
-        self.timer = 0.0
-        self.frametime = 1.0 / self.speed
-
-    def update_animation(self, t):
-        self.timer += t
-        frame = int(self.timer / self.frametime)
-        if frame < 3:
-            glyph_name = self.animation[tuple(self.dir)][frame]
-            self.glyph = self.world.glyph(glyph_name)
-            return True
+        self.frame = 0
+        self.alarm = self.world.after(1.0 / self.speed, self.animate,
+            repeat=True)
+
+    # carry on with a swing saved at frame, with left seconds to the next
+    # one (see pack_object)
+    def resume(self, frame, left):
+        self.frame = frame
+        self.alarm.cancel()
+        self.alarm = self.world.after(1.0 / self.speed, self.animate,
+            repeat=True, first=left)
+
+    # seconds to the next frame
+    def left(self):
+        timers = self.world.timers
+        return max(0.0, self.alarm.due * timers.resolution - self.world.time)
+
+    # next frame of the swing, the sword is gone after the last one
+    def animate(self):
+        if not self.attached():
+            self.alarm.cancel()
+            return
+        self.frame += 1
+        frames = self.animation[tuple(self.dir)]
+        if self.frame < len(frames):
+            self.glyph = self.world.glyph(frames[self.frame])
+            self.world.redraw(self)
         else:
-            return False
+            self.alarm.cancel()
+            self.detach()
     
-    def collision(self, other, post_signal):
-        post_signal += lambda: self.detach()
-        
     def can_pass(self, tile):
         assert self.attached()
         return True
@@ -381,20 +733,13 @@ class Sword(Object):
         
         if not self.try_move(self.vx * t, self.vy * t):
             self.detach()
-            return
-
-        if not self.update_animation(t):
-            self.detach()
-            return
     
 class Bullet(Object):
+    __slots__ = ()
+    obvious = True
+
     def __init__(self, name, glyph, world, **kwargs):
         super(self.__class__, self).__init__(name, glyph, world, **kwargs)
-        self.obvious = True
-        self.on_collision += self.collision
-    
-    def collision(self, other, post_signal):
-        post_signal += lambda: self.detach()
             
     def tick(self, t):
         if not self.attached():
@@ -404,39 +749,111 @@ class Bullet(Object):
             self.detach()
     
 class Item(Object):
+    __slots__ = ()
+
     def __init__(self, name, glyph, world, **kwargs):
         super(self.__class__, self).__init__(name, glyph, world, **kwargs)
 
 class Monster(Object):
+    __slots__ = ("speed",)
+
     def __init__(self, name, glyph, world, **kwargs):
         super(self.__class__, self).__init__(name, glyph, world, **kwargs)
         self.speed = kwargs.get("speed", 0.0)
-        self.on_collision += self.collision
-    def collision(self, other, post_signal):
-        if other.__class__.__name__ == 'Bullet':
-            post_signal += lambda: self.detach()
-        elif other.__class__.__name__ == 'Sword':
-            post_signal += lambda: self.detach()
     
     def tick(self, t):
         if not self.attached():
             return
         speed = self.speed * t
         while speed > 0.0:
-            if random.random() <= min(speed, 1.0):
-                self.try_move(random.randint(0,2) - 1, random.randint(0,2) - 1)
+            if self.world.random.random() <= min(speed, 1.0):
+                # hunt along the flow field, or wander
+                step = self.world.flow_step(self.x, self.y)
+                if step:
+                    self.try_move(*step)
+                else:
+                    rand = self.world.random.randint
+                    self.try_move(rand(0,2) - 1, rand(0,2) - 1)
             speed -= 1.0
     def can_pass(self, tile):
         # prevent monsters from moving over tiles that can conceal player
         return super(self.__class__, self).can_pass(tile) and not tile.conceal
 
+# Collision handlers, by pair of classes.  handler(a, b) is called when a
+# new contact between a (an instance of the first class, or of a subclass)
+# and b (the second) is resolved by Map.collide().  Handlers shouldn't
+# detach objects themselves, but pass them to Map.remove_later().
+collision_handlers = {}
+collision_cache = {} # (type, type) -> handler or None, see collision_handler()
+
+def collides(a, b):
+    def register(handler):
+        collision_handlers[(a, b)] = handler
+        collision_cache.clear()
+        return handler
+    return register
+
+# handler for a pair of classes, looked up along both MROs
+def collision_handler(ta, tb):
+    try:
+        return collision_cache[(ta, tb)]
+    except KeyError:
+        pass
+    handler = None
+    for a in ta.__mro__:
+        for b in tb.__mro__:
+            handler = collision_handlers.get((a, b))
+            if handler:
+                break
+        if handler:
+            break
+    collision_cache[(ta, tb)] = handler
+    return handler
+
+@collides(Player, Monster)
+def player_hit(player, monster):
+    player.hp = max(0, player.hp - 25)
+
+@collides(Player, Item)
+def player_pickup(player, item):
+    if item.name == 'gold coin':
+        player.gold += 10
+        player.last_pickup = item.name
+        player.world.remove_later(item)
+    elif item.name == 'health kit':
+        #player.hp += min(player.hp + 25, 100)
+        player.hp = 100
+        player.last_pickup = item.name
+        player.world.remove_later(item)
+
+@collides(Monster, Bullet)
+@collides(Monster, Sword)
+def monster_slain(monster, weapon):
+    monster.world.remove_later(monster)
+
+# swords and bullets are spent on whatever they hit
+@collides(Sword, Object)
+@collides(Bullet, Object)
+def weapon_spent(weapon, other):
+    weapon.world.remove_later(weapon)
+
+# players face the way they last tried to move
+@handles("try_move", Player)
+def player_turned(player, x, y, result):
+    player.orient(x, y, result)
+
 class Tile:
+    # A kind of tile: glyph plus terrain properties.  One instance is shared
+    # by every cell of the map that has it, the map only stores its id.
+    # Cells without objects are represented by their Tile directly, hence
+    # the (always empty) object list.
+    __slots__ = ("glyph", "name", "solid", "plural", "conceal", "obvious",
+        "theme")
+    objects = ()
+
     def __init__(self, glyph, **kwargs):
-        self.objects = []
-        name = kwargs.get("name", "")
-        if not name:
-            self.name = glyph.name
         self.glyph = glyph
+        self.name = kwargs.get("name", "") or glyph.name
         self.properties(**kwargs)
 
     def properties(self, **kwargs):
@@ -446,33 +863,532 @@ class Tile:
         self.obvious = kwargs.get("obvious", False)
         self.theme = kwargs.get("theme", "")
 
+    def key(self):
+        return (self.glyph, self.name, self.solid, self.plural,
+            self.conceal, self.obvious, self.theme)
+
+class Cell:
+    # An occupied map cell, created when the first object enters it and
+    # dropped again when the last one leaves.  Terrain comes from its Tile.
+    # objects is a dict used as an ordered set (values are unused).
+    __slots__ = ("tile", "objects")
+
+    def __init__(self, tile):
+        self.tile = tile
+        self.objects = {}
+
+    glyph = property(lambda self: self.tile.glyph)
+    name = property(lambda self: self.tile.name)
+    solid = property(lambda self: self.tile.solid)
+    plural = property(lambda self: self.tile.plural)
+    conceal = property(lambda self: self.tile.conceal)
+    obvious = property(lambda self: self.tile.obvious)
+    theme = property(lambda self: self.tile.theme)
+
+# the (x, y) at Chebyshev distance k from (x0, y0): the square ring of
+# cells (or chunks) k steps around it
+def square_ring(x0, y0, k):
+    if k == 0:
+        return [(x0, y0)]
+    r = [(x, y0 - k) for x in range(x0 - k, x0 + k + 1)]
+    r += [(x, y0 + k) for x in range(x0 - k, x0 + k + 1)]
+    for y in range(y0 - k + 1, y0 + k):
+        r.append((x0 - k, y))
+        r.append((x0 + k, y))
+    return r
+
 class Map:
-    def __init__(self, name, w, h, fill):
+    # seed (opt): makes generation (sprinkle, random_teleport) repeatable
+    def __init__(self, name, w, h, fill, seed=None):
         self.name = name
         self.w = w
         self.h = h
-        line = []
-        self.grid = []
-        for t in range(w):
-            line.append(Tile(fill, obvious=True))
-        for t in range(h):
-            self.grid.append(copy.deepcopy(line))
+        self.random = random.Random(seed)
+
+        # the grid holds one tile id per cell (row-major), ids index into
+        # self.tiles.  Objects live in self.cells, keyed by grid index.
+        self.tiles = []
+        self.tile_ids = {}
+        fill_id = self.tile_id(Tile(fill, obvious=True))
+        self.grid = array.array('H', [fill_id]) * (w * h)
+        self.cells = {}
+
+        # objects are also bucketed by chunk (chunk_size square regions) so
+        # simulate() can find the ones near the player.  chunk_time is the
+        # simulation time each chunk was last advanced to.
+        self.chunk_size = 16
+        self.chunks = {}
+        self.chunk_time = {}
+        self.time = 0.0
+        self.catchup_limit = 1.0
+
+        self.profiler = Profiler()
+
+        # held while the world changes, so a background thread can change
+        # it too (see StagedMap)
+        self.lock = threading.RLock()
+
+        # new contacts (pairs of objects) since the last collision pass
+        self.contacts = []
+
+        # events and actions deferred to the end of the collision pass
+        self.events = EventBus()
+
+        # alarms, see after()
+        self.timers = TimerWheel()
+
+        # array-backed populations (see Population), stepped every tick
+        self.populations = []
+
+        # bumped whenever an object or tile changes, so front-ends can
+        # skip redrawing an unchanged world.  tile_version only counts
+        # tile changes.
+        self.version = 0
+        self.tile_version = 0
+        # tile_version of the last change by chunk, and of the last change
+        # that could be anywhere
+        self.chunk_tile_versions = {}
+        self.tile_epoch = 0
+        # cells changed since the last take_changes(), while tracked
+        self.changes = None
+
+        # what can be seen from where
+        self.fov = FieldOfView(self)
+
+        # the FlowField monsters hunt along (see Simulation), updated every
+        # tick
+        self.flow_field = None
         
         self.nothing_glyph = None
         
         self.glyphs = {}
         self.glyphs[fill.name] = fill
         
-        self.objects = []
+        # every object in the world, a dict used as an ordered set.
+        # removed holds objects detached since the last prune()
+        self.objects = {}
+        self.removed = []
         self.object_factories = {}
-    
-    def tile(self, x, y):
+
+        # cached free cell masks, see free_mask()
+        self.free_masks = {}
+
+        # recycled objects of pooled factories, see spawn()
+        self.pools = {}
+        self.pool_stats = {}
+        self.pool_limit = 1024
+
+    # id of an equivalent tile kind, registering it if it is new
+    def tile_id(self, tile):
+        key = tile.key()
+        i = self.tile_ids.get(key)
+        if i is None:
+            i = len(self.tiles)
+            self.tiles.append(tile)
+            self.tile_ids[key] = i
+        return i
+
+    # grid index of a position, None if out of range
+    def index(self, x, y):
         (x,y) = (int(round(x)),int(round(y)))
         if x < 0 or y < 0:
             return None
         if x >= self.w or y >= self.h:
             return None
-        return self.grid[y][x]
+        return y * self.w + x
+    
+    def tile(self, x, y):
+        i = self.index(x, y)
+        if i is None:
+            return None
+        cell = self.cells.get(i)
+        if cell:
+            return cell
+        return self.tiles[self.grid[i]]
+
+    # tile kind at a grid index, ignoring objects
+    def terrain(self, i):
+        return self.tiles[self.grid[i]]
+
+    # chunk key (chunk column, chunk row) of a grid index
+    def chunk_key(self, i):
+        return (i % self.w // self.chunk_size, i // self.w // self.chunk_size)
+
+    # Record which cells change from now on, for front-ends that only
+    # redraw what changed (see take_changes).  Off by default.
+    def track_changes(self):
+        self.changes = {}
+
+    # The changes since the last call: chunk key -> indices of the cells
+    # that changed in it (None if the whole chunk may have), and a None
+    # key if anything anywhere may have
+    def take_changes(self):
+        (changes, self.changes) = (self.changes, {})
+        return changes
+
+    # cell i looks different (while changes are tracked)
+    def mark(self, i):
+        key = self.chunk_key(i)
+        cells = self.changes.get(key, ())
+        if cells == ():
+            cells = self.changes[key] = set()
+        if cells is not None:
+            cells.add(i)
+
+    # obj looks different without having moved (e.g. a new glyph)
+    def redraw(self, obj):
+        if self.changes is not None and obj.cell_index is not None:
+            self.mark(obj.cell_index)
+
+    # indices of the cells of changes (see take_changes) in the rectangle
+    # x0 <= x < x1, y0 <= y < y1, None if it may have changed all over
+    def changes_in(self, changes, x0, y0, x1, y1):
+        if None in changes:
+            return None
+        (w, cs) = (self.w, self.chunk_size)
+        r = []
+        for ky in range(y0 // cs, (y1 - 1) // cs + 1):
+            for kx in range(x0 // cs, (x1 - 1) // cs + 1):
+                cells = changes.get((kx, ky), ())
+                if cells is None:
+                    return None
+                for i in cells:
+                    if x0 <= i % w < x1 and y0 <= i // w < y1:
+                        r.append(i)
+        return r
+
+    # put obj into the cell and chunk at its position
+    def enter(self, obj):
+        if obj.cell_index is not None:
+            return
+        i = self.index(obj.x, obj.y)
+        if i is None:
+            return
+        # the terrain first: on a ChunkedMap that can generate the chunk,
+        # which may put objects in this very cell
+        tile = self.terrain(i)
+        cell = self.cells.get(i)
+        if not cell:
+            cell = self.cells[i] = Cell(tile)
+        cell.objects[obj] = None
+        obj.cell_index = i
+        self.version += 1
+        if self.changes is not None:
+            self.mark(i)
+        key = self.chunk_key(i)
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.chunks[key] = {}
+        chunk[obj] = None
+
+    # take obj out of its cell and chunk, returns False if not attached
+    def leave(self, obj):
+        i = obj.cell_index
+        if i is None:
+            return False
+        obj.cell_index = None
+        self.version += 1
+        if self.changes is not None:
+            self.mark(i)
+        cell = self.cells[i]
+        del cell.objects[obj]
+        if not cell.objects:
+            del self.cells[i]
+        key = self.chunk_key(i)
+        chunk = self.chunks[key]
+        del chunk[obj]
+        if not chunk:
+            del self.chunks[key]
+        return True
+
+    # move obj to (x, y), keeping it attached.  True if it changed cells
+    def place(self, obj, x, y):
+        if obj.cell_index is not None and obj.cell_index == self.index(x, y):
+            (obj.x, obj.y) = (x, y) # same cell
+            self.version += 1
+            return False
+        self.leave(obj)
+        (obj.x, obj.y) = (x, y)
+        self.enter(obj)
+        return obj.cell_index is not None
+
+    # record contacts between obj and the others in the cell at (x, y).
+    # Population members there become objects to take part.
+    def contact(self, obj, x, y):
+        i = self.index(x, y)
+        for pop in self.populations:
+            slot = pop.at.get(i)
+            if slot is not None:
+                pop.materialize(slot)
+        cell = self.cells.get(i)
+        if cell:
+            for other in cell.objects:
+                if other is not obj:
+                    self.contacts.append((obj, other))
+
+    # first step from (x, y) toward the nearest goal of the flow field,
+    # None if none is in reach
+    def flow_step(self, x, y):
+        found = self.flow_field and self.flow_field.lookup(x, y)
+        return found and found[1]
+
+    # the population with a member at (x, y), if any
+    def population_at(self, x, y):
+        i = self.index(x, y)
+        for pop in self.populations:
+            if i in pop.at:
+                return pop
+        return None
+
+    # Spatial queries.  They are answered from the chunk buckets, which
+    # enter() and leave() keep up to date as objects attach, move and
+    # detach, so they only look at the objects in the chunks around the
+    # area asked about.  Positions count as their cell.  Members of
+    # populations aren't objects and aren't found (see population_at).
+
+    # attached objects in the rectangle x0 <= x <= x1, y0 <= y <= y1
+    def objects_in(self, x0, y0, x1, y1):
+        (x0, y0, x1, y1) = (int(round(x0)), int(round(y0)),
+            int(round(x1)), int(round(y1)))
+        cs = self.chunk_size
+        (kx0, ky0, kx1, ky1) = (x0 // cs, y0 // cs, x1 // cs, y1 // cs)
+        if (kx1 - kx0 + 1) * (ky1 - ky0 + 1) > len(self.chunks):
+            # a big rectangle, look at the chunks that have objects instead
+            keys = [key for key in self.chunks
+                if kx0 <= key[0] <= kx1 and ky0 <= key[1] <= ky1]
+        else:
+            keys = [(kx, ky) for ky in range(ky0, ky1 + 1)
+                for kx in range(kx0, kx1 + 1)]
+        r = []
+        for key in keys:
+            chunk = self.chunks.get(key)
+            if not chunk:
+                continue
+            if x0 <= key[0] * cs and (key[0] + 1) * cs <= x1 + 1 and \
+                    y0 <= key[1] * cs and (key[1] + 1) * cs <= y1 + 1:
+                r.extend(chunk) # all inside
+                continue
+            for obj in chunk:
+                (x, y) = (int(round(obj.x)), int(round(obj.y)))
+                if x0 <= x <= x1 and y0 <= y <= y1:
+                    r.append(obj)
+        return r
+
+    # attached objects within radius (in cells) of (x, y), nearest first.
+    # cls (opt): only instances of cls
+    def objects_near(self, x, y, radius, cls=None):
+        r = []
+        for obj in self.objects_in(x - radius, y - radius, x + radius,
+                y + radius):
+            if cls is None or isinstance(obj, cls):
+                d = (obj.x - x) ** 2 + (obj.y - y) ** 2
+                if d <= radius * radius:
+                    r.append((d, obj))
+        r.sort(key=lambda e: e[0])
+        return [obj for (d, obj) in r]
+
+    # the attached object nearest to (x, y) within radius (in cells, the
+    # whole map by default), None if there is none.  name, cls (opt):
+    # only objects of that name, instances of cls.  Chunks are searched
+    # in rings outwards until no nearer object can be left.
+    def nearest(self, x, y, name=None, cls=None, radius=None):
+        if radius is None:
+            radius = max(self.w, self.h)
+        cs = self.chunk_size
+        (kx, ky) = (int(round(x)) // cs, int(round(y)) // cs)
+        best = None
+        best_d = radius * radius
+        for k in range(radius // cs + 2):
+            # whatever is in ring k is at least (k - 1) chunks away
+            if best is not None and ((k - 1) * cs) ** 2 > best_d:
+                break
+            for key in square_ring(kx, ky, k):
+                for obj in self.chunks.get(key, ()):
+                    if (name is None or obj.name == name) and \
+                            (cls is None or isinstance(obj, cls)):
+                        d = (obj.x - x) ** 2 + (obj.y - y) ** 2
+                        if d < best_d or (d == best_d and best is None):
+                            (best, best_d) = (obj, d)
+        return best
+
+    # the cell nearest to (x, y) (in 8-way steps) that obj could be put
+    # in: one it can pass, with no objects in it.  None if there is none
+    # within radius steps
+    def nearest_free(self, x, y, obj, radius):
+        (x, y) = (int(round(x)), int(round(y)))
+        for k in range(radius + 1):
+            for (cx, cy) in square_ring(x, y, k):
+                tile = self.tile(cx, cy)
+                if tile and not tile.objects and obj.can_pass(tile):
+                    return (cx, cy)
+        return None
+
+    # Walk the cells crossed by the segment from (x, y) to (x+dx, y+dy) in
+    # order (a DDA grid traversal; cells are centered on whole numbers),
+    # stopping before the first cell whose tile passable() rejects or that
+    # is off the map.  Returns (cells, t): the (x, y) of the cells entered,
+    # the start cell excluded, and how far along the segment (0 to 1) the
+    # walk got.  The point at t is inside the last cell entered.
+    def sweep(self, x, y, dx, dy, passable):
+        (cx, cy) = (int(round(x)), int(round(y)))
+        (ex, ey) = (int(round(x + dx)), int(round(y + dy)))
+        (sx, sy) = ((dx > 0) - (dx < 0), (dy > 0) - (dy < 0))
+        # t of the next vertical/horizontal cell boundary, and per cell
+        inf = float("inf")
+        (tx, ty) = (inf, inf)
+        (ddx, ddy) = (inf, inf)
+        if sx:
+            ddx = abs(1.0 / dx)
+            tx = (cx + 0.5 * sx - x) / dx
+        if sy:
+            ddy = abs(1.0 / dy)
+            ty = (cy + 0.5 * sy - y) / dy
+
+        cells = []
+        t = 0.0 # where we entered the current cell
+        # steps left in each direction, so we end up exactly in the cell
+        # the end point rounds to
+        (nx, ny) = (abs(ex - cx), abs(ey - cy))
+        while nx or ny:
+            if nx and (tx < ty or not ny):
+                (t_next, cx, tx) = (tx, cx + sx, tx + ddx)
+                nx -= 1
+            else:
+                (t_next, cy, ty) = (ty, cy + sy, ty + ddy)
+                ny -= 1
+            t_next = min(t_next, 1.0) # .5 ties when rounding the end point
+            tile = self.tile(cx, cy)
+            if not tile or not passable(tile):
+                if not cells:
+                    return (cells, 0.0)
+                # halfway through the last cell we could enter
+                return (cells, (t + t_next) * 0.5)
+            cells.append((cx, cy))
+            t = t_next
+        return (cells, 1.0)
+
+    # detach obj at the end of the collision pass
+    def remove_later(self, obj):
+        self.events.defer(obj, Object.detach)
+
+    # an Alarm going off length seconds of simulation time from now
+    def after(self, length, event, repeat=False, first=None):
+        return self.timers.add(Alarm(length, event, repeat), self.time,
+            first)
+
+    # Resolve the contacts recorded since the last call: every pair is
+    # handled once, in both directions, through collision_handlers.  Then
+    # the deferred actions run, detaching the objects the handlers passed
+    # to remove_later().
+    def collide(self):
+        if self.contacts:
+            seen = set()
+            collisions = 0
+            for (a, b) in self.contacts:
+                pair = (a, b) if id(a) < id(b) else (b, a)
+                if pair in seen:
+                    continue
+                seen.add(pair)
+                handler = collision_handler(type(a), type(b))
+                if handler:
+                    handler(a, b)
+                    collisions += 1
+                handler = collision_handler(type(b), type(a))
+                if handler:
+                    handler(b, a)
+                    collisions += 1
+            del self.contacts[:]
+            counts = self.events.counts
+            counts["collision"] = counts.get("collision", 0) + collisions
+        self.events.drain()
+
+    # generate whatever isn't yet (see StagedMap)
+    def finish(self):
+        pass
+
+    # fraction of the map generated so far
+    def progress(self):
+        return 1.0
+
+    # drop objects detached since the last call from self.objects
+    def prune(self):
+        for obj in self.removed:
+            if not obj.attached() and obj in self.objects:
+                del self.objects[obj]
+                if obj.pool is not None and len(obj.pool) < self.pool_limit:
+                    obj.pool.append(obj)
+        del self.removed[:]
+
+    # keys of the chunks overlapping the square of the given radius
+    # around each of centers
+    def chunks_near(self, centers, radius):
+        keys = {}
+        cs = self.chunk_size
+        for (x, y) in centers:
+            (x, y) = (int(round(x)), int(round(y)))
+            x0 = max(0, x - radius) // cs
+            y0 = max(0, y - radius) // cs
+            x1 = min(self.w - 1, x + radius) // cs
+            y1 = min(self.h - 1, y + radius) // cs
+            for cy in range(y0, y1 + 1):
+                for cx in range(x0, x1 + 1):
+                    keys[(cx, cy)] = None
+        return list(keys)
+
+    # Advance the world by t seconds, ticking only the objects in chunks
+    # within radius of one of centers (usually the player).  Objects
+    # elsewhere sleep.  When a chunk wakes up, its objects first get a
+    # single catch-up tick for the time they slept (at most catchup_limit).
+    # Collisions from the whole step are resolved at the end.
+    def simulate(self, t, centers, radius):
+        self.time += t
+        if self.flow_field:
+            self.flow_field.update()
+        for pop in self.populations:
+            pop.step(t)
+        keys = self.chunks_near(centers, radius)
+        for key in keys:
+            lag = min(self.time - t - self.chunk_time.get(key, 0.0),
+                self.catchup_limit)
+            self.chunk_time[key] = self.time
+            if lag > t * 0.5 and key in self.chunks:
+                for obj in list(self.chunks[key]):
+                    if obj.attached():
+                        obj.tick(lag)
+        
+        # collect first, so objects moving between chunks tick only once
+        active = []
+        for key in keys:
+            active.extend(self.chunks.get(key, ()))
+        if self.profiler.enabled:
+            perf_counter = time.perf_counter
+            for obj in active:
+                if obj.attached():
+                    t0 = perf_counter()
+                    obj.tick(t)
+                    self.profiler.tick_cost(obj.__class__.__name__,
+                        perf_counter() - t0)
+        else:
+            for obj in active:
+                if obj.attached():
+                    obj.tick(t)
+
+        self.timers.advance(self.time)
+        self.collide()
+
+    def set_tile(self, x, y, tile):
+        i = self.index(x, y)
+        if i is None:
+            return
+        tid = self.tile_id(tile)
+        self.grid[i] = tid
+        self.version += 1
+        if self.changes is not None:
+            self.mark(i)
+        self.tile_version += 1
+        self.chunk_tile_versions[self.chunk_key(i)] = self.tile_version
+        if i in self.cells:
+            self.cells[i].tile = self.tiles[tid]
     
     #def structure(self, **kwargs):
     #    doors = kwargs["doors"]
@@ -492,13 +1408,78 @@ class Map:
         return self.sprinkle_object(T, freq, **kwargs)
         
     def sprinkle_tile(self, glyph, freq, **kwargs):
-        i = 0
-        for row in self.grid:
-            for tile in row:
-                if random.random() <= freq:
-                    tile.glyph = glyph
-                    tile.name = glyph.name
-                    tile.properties(**kwargs)
+        tid = self.tile_id(Tile(glyph, **kwargs))
+        tile = self.tiles[tid]
+        grid = self.grid
+        for i in self.scatter(freq, len(grid)):
+            grid[i] = tid
+            if i in self.cells:
+                self.cells[i].tile = tile
+        self.version += 1
+        if self.changes is not None:
+            self.changes[None] = None
+        self.tile_version += 1
+        self.tile_epoch = self.tile_version
+
+    # indices in range(n), each picked with likelihood freq.  The gaps
+    # between picks are drawn from a geometric distribution, so this costs
+    # one random number per pick instead of one per index.
+    def scatter(self, freq, n):
+        if freq <= 0.0:
+            return []
+        if freq >= 1.0:
+            return list(range(n))
+        log_q = math.log(1.0 - freq)
+        rand = self.random.random
+        r = []
+        i = int(math.log(1.0 - rand()) / log_q)
+        while i < n:
+            r.append(i)
+            i += 1 + int(math.log(1.0 - rand()) / log_q)
+        return r
+
+    # per tile id, whether obj can stand on it
+    def passable(self, obj):
+        return tuple(bool(obj.can_pass(t)) for t in self.tiles)
+
+    # A byte per cell, set if it is unoccupied and obj can stand on it.
+    # Masks are kept (one per set of passable tiles) until the world
+    # changes, so a generation pass builds each once: sprinkle_object
+    # clears the cells it fills and keeps its mask current.
+    def free_mask(self, obj):
+        passable = self.passable(obj)
+        entry = self.free_masks.get(passable)
+        if entry and entry[0] == self.version:
+            return entry[1]
+        mask = bytearray(map(passable.__getitem__, self.grid))
+        for i in self.cells:
+            mask[i] = 0
+        self.free_masks = dict((k, e) for (k, e) in self.free_masks.items()
+            if e[0] == self.version)
+        self.free_masks[passable] = [self.version, mask]
+        return mask
+
+    # grid indices of unoccupied cells that obj can stand on
+    def free_cells(self, obj):
+        mask = self.free_mask(obj)
+        return list(itertools.compress(range(len(mask)), mask))
+
+    # count distinct unoccupied cells obj can stand on, drawn by picking
+    # cells at random and rejecting the others: no pass over the grid,
+    # for counts small next to the map.  None if too many are rejected
+    # (a crowded map), see free_cells.
+    def sample_free(self, obj, count):
+        passable = self.passable(obj)
+        (grid, cells, n, rand) = (self.grid, self.cells, len(self.grid),
+            self.random.random)
+        picked = {}
+        for tries in range(4 * count + 16):
+            i = int(rand() * n)
+            if passable[grid[i]] and i not in cells and i not in picked:
+                picked[i] = None
+                if len(picked) == count:
+                    return list(picked)
+        return None
     
     # factory must be:
     #   - a function returning a new object
@@ -508,6 +1489,8 @@ class Map:
     #   - an integer >=1, for exact number of objects
     #   OR
     #   - float, decimal between 0 and 1, for likelihood of occurrence
+    # objects are placed on distinct free cells; if there are fewer free
+    # cells than objects, the extra objects are not created
     def sprinkle_object(self, factory, freq, **kwargs):
         r = []
         if int(freq) >= 1: # treat freq as object count
@@ -516,24 +1499,109 @@ class Map:
             count = int(freq * self.w * self.h)
         
         if isinstance(factory, str):
-            factory = object_factories[factory]
+            factory = self.object_factories[factory]
         
-        for i in range(count):
-            p = factory(**kwargs)
-            self.ensure_object(p)
-            p.random_teleport()
+        if count <= 0:
+            return r
+
+        # the first object decides which tiles are passable for all of them
+        p = factory(**kwargs)
+        mask = None
+        picks = None
+        if count * 16 <= len(self.grid):
+            picks = self.sample_free(p, count)
+        if picks is None:
+            mask = self.free_mask(p)
+            free = list(itertools.compress(range(len(mask)), mask))
+            picks = self.random.sample(free, min(count, len(free)))
+        for i in picks:
+            if not p:
+                p = factory(**kwargs)
+            self.objects[p] = None
+            (x, y) = (i % self.w, i // self.w)
+            if isinstance(p.x, float):
+                p.teleport(x * 1.0, y * 1.0)
+            else:
+                p.teleport(x, y)
             r.append(p)
+            p = None
+        if mask is not None and r:
+            for i in picks:
+                mask[i] = 0
+            self.free_masks[self.passable(r[0])][0] = self.version
         return r
 
+    # new object from a registered factory, attached.  For pooled
+    # factories a pruned instance is reused (through its reset()) if any
     def spawn(self, name, **kwargs):
-        p = self.object_factories[name](**kwargs)
+        pool = self.pools.get(name)
+        if pool:
+            p = pool.pop()
+            p.reset(**kwargs)
+            self.pool_stats[name][0] += 1
+        else:
+            p = self.object_factories[name](**kwargs)
+            if pool is not None:
+                p.pool = pool
+                self.pool_stats[name][1] += 1
         self.ensure_object(p)
         p.attach()
         return p
 
+    # name -> {hits, misses, free} for pooled factories
+    def pool_report(self):
+        return dict((name, {
+            "hits": stats[0],
+            "misses": stats[1],
+            "free": len(self.pools[name]),
+        }) for (name, stats) in self.pool_stats.items())
+
+    # part -> bytes, what the world's data structures take up.  Sizes are
+    # shallow (sys.getsizeof) of the containers and of what they hold
+    # directly, objects counting their coordinates too: for budgets, not
+    # to the byte.  "events" includes the handler tables all worlds share.
+    def memory_report(self):
+        size = sys.getsizeof
+        def each(items):
+            return sum(size(item) for item in items)
+        grid = self.grid
+        if grid is None:
+            grid = 0
+        elif isinstance(grid, memoryview):
+            grid = grid.nbytes # mapped from a snapshot
+        else:
+            grid = size(grid)
+        objects = list(self.objects)
+        for pool in self.pools.values():
+            objects.extend(pool)
+        field = self.flow_field
+        return {
+            "grid": grid,
+            "tiles": size(self.tiles) + each(self.tiles) +
+                size(self.tile_ids),
+            "glyphs": size(self.glyphs) + each(self.glyphs.values()),
+            "objects": size(self.objects) + each(objects) +
+                sum(size(obj.x) + size(obj.y) for obj in objects) +
+                each(self.pools.values()),
+            "cells": size(self.cells) + each(self.cells.values()) +
+                sum(size(cell.objects) for cell in self.cells.values()),
+            "chunks": size(self.chunks) + each(self.chunks.values()) +
+                size(self.chunk_time) + size(self.chunk_tile_versions),
+            "populations": sum(size(pop.x) + size(pop.y) + size(pop.speed) +
+                size(pop.alive) + size(pop.at) for pop in self.populations),
+            "events": size(self.events.queue) + size(self.events.counts) +
+                size(event_handlers) + size(event_cache) +
+                size(collision_handlers) + size(collision_cache),
+            "flow field": field and size(field.steps) +
+                size(field.clusters) + each(field.clusters.values()) or 0,
+            "free masks": sum(size(mask)
+                for (version, mask) in self.free_masks.values()),
+            "field of view": size(self.fov.cache) +
+                sum(size(cells) for (v, cells) in self.fov.cache.values()),
+        }
+
     def ensure_object(self, p):
-        if p not in self.objects:
-            self.objects.append(p)
+        self.objects[p] = None
         
     def snap(self, x, y):
         use_floats = isinstance(x, float)
@@ -561,35 +1629,1033 @@ class Map:
 
     # factory prototype is T(name, glyph, world, **kwargs)
     #   where T is Object or derived class of Object
-    def register_object_factory(self, name, factory):
+    # pool: recycle the objects spawn() makes once they are pruned, for
+    #   short-lived objects (bullets, swords).  Objects must support reset()
+    def register_object_factory(self, name, factory, pool=False):
         self.object_factories[name] = factory
+        if pool:
+            self.pools[name] = []
+            self.pool_stats[name] = [0, 0] # hits, misses
         
-    def render(self, win, camera, view):
+    # visible (opt): the cells seen (see FieldOfView), objects elsewhere
+    #   aren't drawn, only the terrain
+    def render(self, win, camera, view, visible=None):
         # render visible map region based on camera and viewport
-        for ix in range(0,view[2]):
-            for iy in range(0,view[3]):
-                # adding camera coords transforms us into world space
-                # use world space coords to get tile, null if out of range
-                tile = self.tile(ix + camera[0], iy + camera[1])
-                if tile:
-                    # if tile has no objects or is concealing them
-                    if not tile.objects or tile.conceal:
-                        draw(win, tile.glyph, ix + view[0], iy + view[1])
-                    else:
-                        # draw first object
-                        for obj in tile.objects:
-                            draw(win, obj.glyph, ix + view[0], iy + view[1])
-                            break
+        # adding camera coords transforms us into world space
+        (cx, cy) = (int(round(camera[0])), int(round(camera[1])))
+        w = self.w
+        for iy in range(0,view[3]):
+            y = iy + cy
+            sy = iy + view[1]
+            for ix in range(0,view[2]):
+                x = ix + cx
+                if 0 <= x < w and 0 <= y < self.h:
+                    glyph = self.cell_glyph(y * w + x, x, y, visible)
                 else:
                     # tile is out of range, draw placeholders
-                    if self.nothing_glyph:
-                        draw(win, self.nothing_glyph, ix + view[0], iy + view[1])
+                    glyph = self.nothing_glyph
+                    if not glyph:
+                        continue
+                draw(win, glyph, ix + view[0], sy)
+
+    # render only the cells (grid indices) of the view given, see
+    # take_changes
+    def render_cells(self, win, camera, view, visible, cells):
+        (cx, cy) = (int(round(camera[0])), int(round(camera[1])))
+        w = self.w
+        for i in cells:
+            (x, y) = (i % w, i // w)
+            (ix, iy) = (x - cx, y - cy)
+            if 0 <= ix < view[2] and 0 <= iy < view[3]:
+                draw(win, self.cell_glyph(i, x, y, visible), ix + view[0],
+                    iy + view[1])
+
+    # what cell i, at (x, y), shows: its first object, unless there is
+    # none, the tile conceals it or it can't be seen, and then a
+    # population member seen there or the tile
+    def cell_glyph(self, i, x, y, visible):
+        cell = self.cells.get(i)
+        if not cell or cell.tile.conceal or \
+                (visible is not None and (x, y) not in visible):
+            glyph = self.tiles[self.grid[i]].glyph
+            for pop in self.populations:
+                if i in pop.at and (visible is None or (x, y) in visible):
+                    glyph = pop.glyph
+            return glyph
+        for obj in cell.objects:
+            return obj.glyph
+
+class RuledMap(Map):
+    # A Map generated a chunk (chunk_size square) at a time.  sprinkle()
+    # only records rules; each chunk replays them (see replay) with its own
+    # random generator, seeded from (seed, chunk coords), so a chunk comes
+    # out the same whenever and in whatever order it is generated.  Object
+    # factories get that generator as world.random while a chunk is
+    # generated.  Subclasses say when the map is in use (used()), after
+    # which no more rules can be given.
+    def __init__(self, name, w, h, fill, seed=None):
+        Map.__init__(self, name, w, h, fill, seed)
+        if seed is None:
+            seed = self.random.getrandbits(64)
+        self.seed = seed
+        self.tile_rules = []   # (tile id, freq)
+        self.object_rules = [] # (factory, freq, kwargs)
+
+    # whether any chunk has been generated
+    def used(self):
+        raise NotImplementedError
+
+    # Run the rules over chunk key: tile ids go into tiles[offset(j)] for
+    # each chunk cell j (row-major), objects onto the cells they can stand
+    # on that are empty.  offset(j) is None for cells off the map, skipped.
+    # Without objects, only the tile rules run.
+    def replay(self, key, tiles, offset, objects=True):
+        (world_random, self.random) = (self.random,
+            random.Random("%s/%d/%d" % (self.seed, key[0], key[1])))
+        try:
+            cs = self.chunk_size
+            (x0, y0) = (key[0] * cs, key[1] * cs)
+            for (tid, freq) in self.tile_rules:
+                for j in self.scatter(freq, cs * cs):
+                    t = offset(j)
+                    if t is not None:
+                        tiles[t] = tid
+            if not objects:
+                return
+            for (factory, freq, kwargs) in self.object_rules:
+                for j in self.scatter(freq, cs * cs):
+                    t = offset(j)
+                    if t is None:
+                        continue
+                    (x, y) = (x0 + j % cs, y0 + j // cs)
+                    if self.index(x, y) in self.cells:
+                        continue
+                    p = factory(**kwargs)
+                    if not p.can_pass(self.tiles[tiles[t]]):
+                        continue
+                    self.objects[p] = None
+                    if isinstance(p.x, float):
+                        p.teleport(x * 1.0, y * 1.0)
+                    else:
+                        p.teleport(x, y)
+        finally:
+            self.random = world_random
+
+    # the rules apply to every chunk, so they must all be given before the
+    # first chunk is generated
+    def sprinkle_tile(self, glyph, freq, **kwargs):
+        assert not self.used(), "sprinkle before the map is used"
+        self.tile_rules.append((self.tile_id(Tile(glyph, **kwargs)), freq))
 
-def main(win):
+    # freq as in Map.sprinkle_object, a count being spread over w x h.
+    # The objects appear as their chunks are generated.
+    def sprinkle_object(self, factory, freq, **kwargs):
+        assert not self.used(), "sprinkle before the map is used"
+        if int(freq) >= 1:
+            freq = int(freq) / float(self.w * self.h)
+        if isinstance(factory, str):
+            factory = self.object_factories[factory]
+        self.object_rules.append((factory, freq, kwargs))
+        return []
+
+class ChunkedMap(RuledMap):
+    # An unbounded RuledMap, whose chunks are generated the first time
+    # anything touches them.
+    # At most `resident` chunks are kept.  Touching another one evicts the
+    # least recently used chunk (never one simulated last step, or holding
+    # a player): its tiles are serialized if they changed (as files in the
+    # store directory, or as bytes in memory), its objects are packed into
+    # OBJECT_RECORDs (see pack_object), and both come back when it is
+    # touched again, with the time it was last simulated.  Unchanged chunks
+    # are just regenerated; freshly generated objects have no time to catch
+    # up on.  Only resident chunks keep a chunk_time.
+    # Grid indices are (x, y) tuples.  w and h only bound random_teleport
+    # and snap, and set the density of sprinkles given as a count.
+    def __init__(self, name, w, h, fill, seed=None, resident=256, store=None):
+        RuledMap.__init__(self, name, 0, 0, fill, seed)
+        (self.w, self.h) = (w, h)
+        self.grid = None
+        self.resident = collections.OrderedDict() # key -> array of tile ids
+        self.capacity = resident
+        self.changed = set()   # resident chunks with changed tiles
+        self.saved = {}        # key -> tile bytes (None: in the store)
+        self.store = store
+        # key -> (chunk time or None, OBJECT_RECORDs of its objects) of an
+        # evicted chunk (its objects were generated, it has some or not)
+        self.sleeping = {}
+        # the strings and glyphs the records refer to, by id
+        (self.strings, self.string_ids) = ([], {})
+        (self.record_glyphs, self.glyph_ids) = ([], {})
+        self.active = set()    # chunks simulated last step
+        self.stats = {"generated": 0, "loaded": 0, "evicted": 0, "saved": 0}
+
+    def index(self, x, y):
+        return (int(round(x)), int(round(y)))
+
+    def tile(self, x, y):
+        i = (int(round(x)), int(round(y)))
+        tile = self.terrain(i) # first, it may wake objects up in the cell
+        return self.cells.get(i) or tile
+
+    def terrain(self, i):
+        (x, y) = i
+        cs = self.chunk_size
+        return self.tiles[self.chunk((x // cs, y // cs))[y % cs * cs + x % cs]]
+
+    def chunk_key(self, i):
+        return (i[0] // self.chunk_size, i[1] // self.chunk_size)
+
+    # tile ids of a chunk (row-major), loading or generating it if needed
+    def chunk(self, key):
+        tiles = self.resident.get(key)
+        if tiles is not None:
+            self.resident.move_to_end(key)
+            return tiles
+        data = self.unsave(key)
+        if data is not None:
+            tiles = self.resident[key] = array.array('H')
+            tiles.frombytes(data)
+            self.changed.add(key)
+            self.stats["loaded"] += 1
+        else:
+            tiles = self.generate(key)
+        (slept, records) = self.sleeping.pop(key, (self.time, b""))
+        if slept is not None:
+            self.chunk_time[key] = slept
+        for k in range(0, len(records), OBJECT_RECORD.size):
+            (obj, player) = unpack_object(self,
+                OBJECT_RECORD.unpack_from(records, k), self.strings,
+                self.record_glyphs)
+            obj.pool = self.pools.get(obj.name)
+            self.ensure_object(obj)
+            obj.attach()
+        self.evict(key)
+        return tiles
+
+    # the chunk's tiles, and its objects unless it has slept (they come
+    # back from its records)
+    def generate(self, key):
+        cs = self.chunk_size
+        tiles = self.resident[key] = array.array('H', [0]) * (cs * cs)
+        self.replay(key, tiles, lambda j: j, key not in self.sleeping)
+        self.stats["generated"] += 1
+        return tiles
+
+    # evict least recently used chunks until at most capacity are left.
+    # Players stay: they are what the rest of the game refers to.
+    def evict(self, keep):
+        while len(self.resident) > self.capacity:
+            for key in self.resident:
+                if key != keep and key not in self.active and not any(
+                        isinstance(obj, Player)
+                        for obj in self.chunks.get(key, ())):
+                    break
+            else:
+                return # all in use
+            self.unload(key)
+
+    def unload(self, key):
+        tiles = self.resident.pop(key)
+        records = []
+        for obj in list(self.chunks.get(key, ())):
+            self.leave(obj)
+            self.objects.pop(obj, None)
+            records.append(pack_object(obj, self.string_id, self.glyph_id))
+        self.sleeping[key] = (self.chunk_time.pop(key, None),
+            b"".join(records))
+        if key in self.changed:
+            self.changed.discard(key)
+            self.save(key, tiles.tobytes())
+        self.stats["evicted"] += 1
+
+    # ids of strings and glyphs in the sleeping records
+    def string_id(self, string):
+        i = self.string_ids.get(string)
+        if i is None:
+            i = self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return i
+
+    def glyph_id(self, glyph):
+        i = self.glyph_ids.get(id(glyph))
+        if i is None:
+            i = self.glyph_ids[id(glyph)] = len(self.record_glyphs)
+            self.record_glyphs.append(glyph)
+        return i
+
+    def chunk_path(self, key):
+        return os.path.join(self.store, "chunk_%d_%d" % key)
+
+    def save(self, key, data):
+        self.stats["saved"] += 1
+        if self.store is None:
+            self.saved[key] = data
+            return
+        with open(self.chunk_path(key), "wb") as f:
+            f.write(data)
+        self.saved[key] = None
+
+    # tile bytes saved for an evicted chunk, None if there are none
+    def unsave(self, key):
+        if key not in self.saved:
+            return None
+        data = self.saved.pop(key)
+        if data is None:
+            path = self.chunk_path(key)
+            with open(path, "rb") as f:
+                data = f.read()
+            os.remove(path)
+        return data
+
+    def memory_report(self):
+        r = Map.memory_report(self)
+        r["grid"] = sys.getsizeof(self.resident) + sum(sys.getsizeof(tiles)
+            for tiles in self.resident.values()) + sum(len(data or b"")
+            for data in self.saved.values())
+        r["sleeping"] = sys.getsizeof(self.sleeping) + sum(
+            sys.getsizeof(entry) + sys.getsizeof(entry[1])
+            for entry in self.sleeping.values())
+        return r
+
+    def set_tile(self, x, y, tile):
+        i = self.index(x, y)
+        key = self.chunk_key(i)
+        tiles = self.chunk(key)
+        tid = self.tile_id(tile)
+        cs = self.chunk_size
+        tiles[i[1] % cs * cs + i[0] % cs] = tid
+        self.changed.add(key)
+        self.version += 1
+        if self.changes is not None:
+            self.changes[key] = None
+        self.tile_version += 1
+        self.chunk_tile_versions[key] = self.tile_version
+        if i in self.cells:
+            self.cells[i].tile = self.tiles[tid]
+
+    def used(self):
+        return bool(self.resident or self.sleeping)
+
+    def chunks_near(self, centers, radius):
+        keys = {}
+        cs = self.chunk_size
+        for (x, y) in centers:
+            (x, y) = (int(round(x)), int(round(y)))
+            for cy in range((y - radius) // cs, (y + radius) // cs + 1):
+                for cx in range((x - radius) // cs, (x + radius) // cs + 1):
+                    keys[(cx, cy)] = None
+        return list(keys)
+
+    def simulate(self, t, centers, radius):
+        self.active = set(self.chunks_near(centers, radius))
+        Map.simulate(self, t, centers, radius)
+        for key in self.active:
+            if key not in self.resident:
+                self.chunk_time.pop(key, None)
+
+    def render(self, win, camera, view, visible=None):
+        (cx, cy) = (int(round(camera[0])), int(round(camera[1])))
+        (tiles, cells, cs) = (self.tiles, self.cells, self.chunk_size)
+        for iy in range(0,view[3]):
+            y = iy + cy
+            sy = iy + view[1]
+            (ky, row) = (y // cs, y % cs * cs)
+            key = chunk = None
+            for ix in range(0,view[2]):
+                x = ix + cx
+                cell = cells.get((x, y))
+                if not cell or cell.tile.conceal or \
+                        (visible is not None and (x, y) not in visible):
+                    if key != x // cs:
+                        key = x // cs
+                        chunk = self.chunk((key, ky))
+                    glyph = tiles[chunk[row + x % cs]].glyph
+                else:
+                    for obj in cell.objects:
+                        glyph = obj.glyph
+                        break
+                draw(win, glyph, ix + view[0], sy)
+
+class StagedMap(RuledMap):
+    # A fixed-size RuledMap, so play can start before the whole map
+    # exists.  start() generates the chunks around a point right
+    # away and the rest from a background thread, nearest first.  A chunk
+    # anything looks at before the thread gets there (tile(), terrain(),
+    # or simulate() within radius + chunk_size of a center) is generated
+    # on the spot, so the game never sees one half made.  Generating takes
+    # the world's lock, which the Simulation holds while it changes the
+    # world.  ready has a byte per chunk (row-major), set once it's done.
+    def __init__(self, name, w, h, fill, seed=None):
+        RuledMap.__init__(self, name, w, h, fill, seed)
+        cs = self.chunk_size
+        self.columns = (w + cs - 1) // cs
+        self.rows = (h + cs - 1) // cs
+        self.ready = bytearray(self.columns * self.rows)
+        self.pending = len(self.ready) # chunks not ready
+        self.generating = None
+        self.thread = None
+
+    def tile(self, x, y):
+        i = self.index(x, y)
+        if i is None:
+            return None
+        cell = self.cells.get(i)
+        if cell:
+            return cell
+        return self.terrain(i)
+
+    def terrain(self, i):
+        if self.pending:
+            self.prepare(self.chunk_key(i))
+        return self.tiles[self.grid[i]]
+
+    # generate the chunk unless it's ready (or being generated, when its
+    # objects are placed)
+    def prepare(self, key):
+        n = key[1] * self.columns + key[0]
+        if self.ready[n]:
+            return
+        with self.lock:
+            if not self.ready[n] and key != self.generating:
+                self.generating = key
+                try:
+                    self.generate(key)
+                finally:
+                    self.generating = None
+                self.ready[n] = 1
+                self.pending -= 1
+
+    def generate(self, key):
+        (w, h, cs) = (self.w, self.h, self.chunk_size)
+        (x0, y0) = (key[0] * cs, key[1] * cs)
+        def offset(j): # grid index of chunk cell j, None off the map
+            (x, y) = (x0 + j % cs, y0 + j // cs)
+            if x < w and y < h:
+                return y * w + x
+            return None
+        self.replay(key, self.grid, offset)
+        self.version += 1
+        if self.changes is not None:
+            self.changes[key] = None
+        self.tile_version += 1
+        self.chunk_tile_versions[key] = self.tile_version
+
+    # generate the chunks within radius of (x, y) now, and the others in
+    # a background thread
+    def start(self, x, y, radius):
+        for key in Map.chunks_near(self, [(x, y)], radius):
+            self.prepare(key)
+        (cx, cy) = (int(x) // self.chunk_size, int(y) // self.chunk_size)
+        keys = [(kx, ky) for ky in range(self.rows)
+            for kx in range(self.columns)]
+        keys.sort(key=lambda k: max(abs(k[0] - cx), abs(k[1] - cy)))
+        self.thread = threading.Thread(target=self.generate_all,
+            args=(keys,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def generate_all(self, keys):
+        for key in keys:
+            self.prepare(key)
+            time.sleep(0) # let the game have the lock (and the GIL)
+
+    def finish(self):
+        for ky in range(self.rows):
+            for kx in range(self.columns):
+                self.prepare((kx, ky))
+
+    def progress(self):
+        return 1.0 - self.pending / float(len(self.ready))
+
+    def used(self):
+        return self.pending != len(self.ready)
+
+    def simulate(self, t, centers, radius):
+        if self.pending:
+            for key in self.chunks_near(centers, radius + self.chunk_size):
+                self.prepare(key)
+        Map.simulate(self, t, centers, radius)
+
+class FieldOfView:
+    # Which cells can be seen from a cell: recursive shadowcasting over the
+    # eight octants, with solid and concealing tiles (rocks, trees,
+    # bushes) blocking the view past them (they are seen themselves).
+    # Results are cached per (x, y, radius, reach) for the last `size`
+    # queries and stay valid until a tile within radius changes, so asking
+    # again from the same cell is a dict lookup and a move costs one cast
+    # over the circle (or the part of it within reach), whatever the size
+    # of the map.
+    # octant transforms (xx, xy, yx, yy)
+    OCTANTS = ((1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+        (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1))
+
+    def __init__(self, world, size=64):
+        self.world = world
+        self.size = size
+        self.cache = collections.OrderedDict() # key -> (tile version, cells)
+        self.casts = 0
+        self.opaque = bytearray() # blocks the view, per tile id
+
+    # frozenset of the (x, y) cells visible from (x, y), itself included.
+    # With reach (rx, ry), only those at most rx columns and ry rows away
+    # (e.g. what fits in a view), which is cheaper to cast.
+    def visible(self, x, y, radius, reach=None):
+        world = self.world
+        key = (int(round(x)), int(round(y)), radius, reach)
+        entry = self.cache.get(key)
+        if entry is not None and self.fresh(key, entry[0]):
+            self.cache.move_to_end(key)
+            return entry[1]
+        cells = self.cast(key[0], key[1], radius, reach)
+        self.cache[key] = (world.tile_version, cells)
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        return cells
+
+    # True if no tile within radius of (x, y) changed since version
+    def fresh(self, key, version):
+        world = self.world
+        if version == world.tile_version:
+            return True
+        if version < world.tile_epoch:
+            return False
+        (x, y, radius) = key[:3]
+        cs = world.chunk_size
+        changed = world.chunk_tile_versions
+        for cy in range((y - radius) // cs, (y + radius) // cs + 1):
+            for cx in range((x - radius) // cs, (x + radius) // cs + 1):
+                if changed.get((cx, cy), -1) > version:
+                    return False
+        return True
+
+    def cast(self, x, y, radius, reach=None):
+        self.casts += 1
+        world = self.world
+        visible = set([(x, y)])
+        if world.grid is not None and not getattr(world, "pending", 0):
+            # straight from the grid, by tile id
+            kinds = self.opaque
+            while len(kinds) < len(world.tiles):
+                tile = world.tiles[len(kinds)]
+                kinds.append(1 if tile.solid or tile.conceal else 0)
+            (grid, w, h) = (world.grid, world.w, world.h)
+            def blocks(cx, cy):
+                return not (0 <= cx < w and 0 <= cy < h) or \
+                    kinds[grid[cy * w + cx]]
+        else:
+            opaque = {} # (x, y) -> blocks the view, for the cells looked at
+            def blocks(cx, cy):
+                b = opaque.get((cx, cy))
+                if b is None:
+                    tile = world.tile(cx, cy)
+                    b = opaque[(cx, cy)] = not tile or tile.solid or \
+                        tile.conceal
+                return b
+        (rx, ry) = reach or (radius, radius)
+        for octant in self.OCTANTS:
+            # the reach along the octant's rows and columns: a cell past
+            # it only shadows cells further past it
+            (xx, xy, yx, yy) = octant
+            bounds = (min(radius, rx if xy else ry), rx if xx else ry)
+            self.scan(x, y, 1, 1.0, 0.0, radius, octant, visible, blocks,
+                bounds)
+        return frozenset(visible)
+
+    # one octant, from row outwards, between the slopes start and end,
+    # up to bounds (last row, furthest column)
+    def scan(self, x, y, row, start, end, radius, octant, visible, blocks,
+            bounds):
+        if start < end:
+            return
+        (xx, xy, yx, yy) = octant
+        radius_sq = radius * radius
+        new_start = start
+        for j in range(row, bounds[0] + 1):
+            blocked = False
+            dy = -j
+            # from the first column at or right of start (one early, for
+            # rounding), the checks below do the rest
+            first = max(-j, -bounds[1],
+                int(math.floor(-start * (j + 0.5) - 0.5)) - 1)
+            (near, far) = (dy + 0.5, dy - 0.5)
+            (ox, oy) = (x + dy * xy, y + dy * yy) # the row's column 0
+            within = radius_sq - dy * dy
+            for dx in range(first, 1):
+                right = (dx + 0.5) / far
+                if start < right:
+                    continue
+                left = (dx - 0.5) / near
+                if end > left:
+                    break
+                (cx, cy) = (ox + dx * xx, oy + dx * yx)
+                if dx * dx <= within:
+                    visible.add((cx, cy))
+                if blocked:
+                    if blocks(cx, cy):
+                        new_start = right
+                    else:
+                        blocked = False
+                        start = new_start
+                elif blocks(cx, cy) and j < radius:
+                    # the rest of this row's view continues past the
+                    # blocker, in its own scan
+                    blocked = True
+                    self.scan(x, y, j + 1, start, left, radius, octant,
+                        visible, blocks, bounds)
+                    new_start = right
+            if blocked:
+                break
+
+class FlowField:
+    # Distances (in 8-way steps, the way monsters move) to the nearest
+    # target's cell, and the first step of a shortest path there, for every
+    # cell within radius of a target, over the tiles can_pass allows.
+    # Targets whose squares (radius around them) overlap form a cluster,
+    # searched with one breadth-first search from all of its goals over
+    # the union of their squares.  Clusters never share a cell, so their
+    # results all go in one dict (steps) and anything following the field
+    # reads its next move with one lookup, whatever the number of targets.
+    # A cluster is only searched again when one of its targets changes
+    # cells (or a tile changes), at a cost bounded by its squares, whatever
+    # the number of followers.  Detached or hiding targets lead nowhere.
+    STEPS = ((-1,-1), (0,-1), (1,-1), (-1,0), (1,0), (-1,1), (0,1), (1,1))
+    # steps keys are y * STRIDE + x, unique for any coordinates a world has
+    STRIDE = 1 << 32
+
+    def __init__(self, world, targets, can_pass, radius=24):
+        self.world = world
+        self.targets = list(targets)
+        self.can_pass = can_pass
+        self.radius = radius
+        self.steps = {} # cell key -> distance * 8 + STEPS index
+        self.clusters = {} # goals (sorted) -> keys of their cells in steps
+        self.tile_version = None
+        self.kinds = bytearray() # can_pass per tile id
+        self.builds = 0
+
+    # lead to new instead of old (e.g. the same player, arrived as a new
+    # object)
+    def retarget(self, old, new):
+        self.targets[self.targets.index(old)] = new
+
+    # cells the targets are in
+    def goals(self):
+        goals = set()
+        for target in self.targets:
+            hiding = getattr(target, "hiding", None)
+            if target.attached() and not (hiding and hiding()):
+                goals.add((int(round(target.x)), int(round(target.y))))
+        return sorted(goals)
+
+    # the goals grouped into clusters, of goals with overlapping squares
+    def cluster(self, goals):
+        reach = 2 * self.radius
+        parent = list(range(len(goals)))
+        def root(i):
+            while parent[i] != i:
+                i = parent[i] = parent[parent[i]]
+            return i
+        for (i, (x, y)) in enumerate(goals):
+            for j in range(i):
+                (gx, gy) = goals[j]
+                if abs(gx - x) <= reach and abs(gy - y) <= reach:
+                    parent[root(i)] = root(j)
+        groups = {}
+        for i in range(len(goals)):
+            groups.setdefault(root(i), []).append(goals[i])
+        return [tuple(group) for group in groups.values()]
+
+    def update(self):
+        if self.tile_version != self.world.tile_version:
+            self.tile_version = self.world.tile_version
+            self.steps.clear()
+            self.clusters.clear()
+        clusters = self.cluster(self.goals())
+        wanted = set(clusters)
+        for (goals, keys) in list(self.clusters.items()):
+            if goals not in wanted:
+                steps = self.steps
+                for key in keys:
+                    del steps[key]
+                del self.clusters[goals]
+        for goals in clusters:
+            if goals not in self.clusters:
+                self.clusters[goals] = self.build(goals)
+
+    # search from goals (a cluster), returns the keys added to steps
+    def build(self, goals):
+        r = self.radius
+        self.builds += 1
+        # the box around the squares plus a border of blocked cells, so
+        # the search needs no bounds checks
+        x0 = min(x for (x, y) in goals) - r - 1
+        y0 = min(y for (x, y) in goals) - r - 1
+        s = max(x for (x, y) in goals) + r + 2 - x0
+        h = max(y for (x, y) in goals) + r + 2 - y0
+        mask = self.mask(goals, x0, y0, s, h)
+        dist = array.array('h', [-1]) * (s * h)
+        flow = bytearray(s * h)
+        moves = [(dy * s + dx, 7 - k) for (k, (dx, dy)) in enumerate(self.STEPS)]
+        queue = [(y - y0) * s + x - x0 for (x, y) in goals]
+        for j in queue:
+            dist[j] = 0
+        for j in queue: # grows as we go
+            d = dist[j] + 1
+            for (offset, back) in moves:
+                n = j + offset
+                if dist[n] < 0 and mask[n]:
+                    dist[n] = d
+                    flow[n] = back
+                    queue.append(n)
+        reached = queue[len(goals):]
+        stride = self.STRIDE
+        keys = [(y0 + j // s) * stride + x0 + j % s for j in reached]
+        self.steps.update(zip(keys, [dist[j] * 8 + flow[j] for j in reached]))
+        return keys
+
+    # 1 for the cells of the goals' squares can_pass allows, in the s x h
+    # box at (x0, y0)
+    def mask(self, goals, x0, y0, s, h):
+        world = self.world
+        r = self.radius
+        mask = bytearray(s * h)
+        if world.grid is not None:
+            kinds = self.kinds
+            while len(kinds) < len(world.tiles):
+                kinds.append(1 if self.can_pass(world.tiles[len(kinds)]) else 0)
+            (grid, w) = (world.grid, world.w)
+            for (gx, gy) in goals:
+                lo = max(gx - r, 0)
+                hi = min(gx + r + 1, w)
+                if lo >= hi:
+                    continue
+                for y in range(max(gy - r, 0), min(gy + r + 1, world.h)):
+                    row = grid[y * w + lo:y * w + hi]
+                    j = (y - y0) * s - x0
+                    mask[j + lo:j + hi] = bytes(map(kinds.__getitem__, row))
+        else:
+            passable = {} # tile kind -> 0/1
+            done = set()
+            for (gx, gy) in goals:
+                for y in range(gy - r, gy + r + 1):
+                    for x in range(gx - r, gx + r + 1):
+                        if (x, y) in done:
+                            continue
+                        done.add((x, y))
+                        tile = world.terrain(world.index(x, y))
+                        ok = passable.get(tile)
+                        if ok is None:
+                            ok = passable[tile] = 1 if self.can_pass(tile) else 0
+                        mask[(y - y0) * s + x - x0] = ok
+        return mask
+
+    # (distance, (dx, dy) first step) from (x, y) toward the nearest goal,
+    # None if none is in reach (or that is a goal)
+    def lookup(self, x, y):
+        v = self.steps.get(int(round(y)) * self.STRIDE + int(round(x)))
+        if v is None:
+            return None
+        return (v >> 3, self.STEPS[v & 7])
+
+class Population:
+    # Lots of objects of one kind (wandering monsters) stored as parallel
+    # arrays (x, y, speed, alive) instead of as Objects.  Each step, the
+    # members that move are picked in one pass and their random steps are
+    # checked against a passability mask over the tile kinds, which
+    # enforces the same rules as the prototype's can_pass.  Members stay
+    # out of each other's cells.  A member that touches an object (the
+    # player, a projectile...) is materialized into a real object made by
+    # factory, which then goes through the usual collision handling.
+    def __init__(self, world, factory):
+        assert world.grid is not None, "Population needs a fixed-size Map"
+        self.world = world
+        self.factory = factory
+        self.prototype = factory()
+        self.name = self.prototype.name
+        self.glyph = self.prototype.glyph
+        self.x = array.array('i')
+        self.y = array.array('i')
+        self.speed = array.array('d')
+        self.alive = bytearray()
+        self.free = [] # dead slots, for reuse
+        self.at = {}   # grid index -> slot of the member there
+        self.top = 0.0 # fastest speed ever added
+        self.passable = bytearray()
+        world.populations.append(self)
+
+    def __len__(self):
+        return len(self.at)
+
+    def add(self, x, y, speed):
+        i = self.world.index(x, y)
+        if i is None or i in self.at:
+            return None
+        if self.free:
+            slot = self.free.pop()
+            (self.x[slot], self.y[slot]) = (x, y)
+            (self.speed[slot], self.alive[slot]) = (speed, 1)
+        else:
+            slot = len(self.alive)
+            self.x.append(x)
+            self.y.append(y)
+            self.speed.append(speed)
+            self.alive.append(1)
+        self.at[i] = slot
+        self.top = max(self.top, speed)
+        self.world.version += 1
+        if self.world.changes is not None:
+            self.world.mark(i)
+        return slot
+
+    def remove(self, slot):
+        i = self.world.index(self.x[slot], self.y[slot])
+        del self.at[i]
+        self.alive[slot] = 0
+        self.free.append(slot)
+        self.world.version += 1
+        if self.world.changes is not None:
+            self.world.mark(i)
+
+    # Place members on free cells, like Map.sprinkle_object.  speed is a
+    # function returning the speed of each new member.
+    def sprinkle(self, freq, speed):
+        world = self.world
+        if int(freq) >= 1:
+            count = int(freq)
+        else:
+            count = int(freq * world.w * world.h)
+        free = world.free_cells(self.prototype)
+        free = [i for i in free if i not in self.at]
+        for i in world.random.sample(free, min(count, len(free))):
+            self.add(i % world.w, i // world.w, speed())
+
+    # replace the member in slot with an attached object made by factory
+    def materialize(self, slot):
+        (x, y, speed) = (self.x[slot], self.y[slot], self.speed[slot])
+        self.remove(slot)
+        obj = self.factory(pos=(x, y))
+        obj.speed = speed
+        self.world.ensure_object(obj)
+        obj.attach()
+        return obj
+
+    def update_mask(self):
+        tiles = self.world.tiles
+        while len(self.passable) < len(tiles):
+            tile = tiles[len(self.passable)]
+            self.passable.append(1 if self.prototype.can_pass(tile) else 0)
+
+    # Random walk, like Monster.tick: each member makes speed * t unit
+    # steps on average.  Movers are drawn in one pass with the likelihood
+    # of the fastest member and then thinned by their own speed.
+    def step(self, t):
+        self.update_mask()
+        if not self.at:
+            return
+        trials = self.top * t
+        while trials > 0.0:
+            self.walk(min(trials, 1.0))
+            trials -= 1.0
+
+    def walk(self, likelihood):
+        world = self.world
+        top = self.top
+        (xs, ys, speeds, alive) = (self.x, self.y, self.speed, self.alive)
+        (grid, cells, at, passable) = (world.grid, world.cells, self.at,
+            self.passable)
+        (w, h) = (world.w, world.h)
+        rand = world.random.random
+        moved = 0
+        for slot in world.scatter(likelihood, len(alive)):
+            if not alive[slot] or rand() * top > speeds[slot]:
+                continue
+            d = int(rand() * 9)
+            step = world.flow_field and world.flow_step(xs[slot], ys[slot])
+            if step:
+                (dx, dy) = step
+            else:
+                (dx, dy) = (d % 3 - 1, d // 3 - 1)
+            (x, y) = (xs[slot] + dx, ys[slot] + dy)
+            if not (0 <= x < w and 0 <= y < h):
+                continue
+            i = y * w + x
+            if i in at or not passable[grid[i]]:
+                continue
+            if i in cells:
+                # walking into an object, let the real thing do it
+                self.materialize(slot).try_move(dx, dy)
+                continue
+            j = ys[slot] * w + xs[slot]
+            del at[j]
+            at[i] = slot
+            (xs[slot], ys[slot]) = (x, y)
+            moved += 1
+            if world.changes is not None:
+                world.mark(j)
+                world.mark(i)
+        world.version += moved
+
+class Screen:
+    # Double-buffered stand-in for a curses window.  Map.render and
+    # hud_render draw into it like into a window (addstr/getmaxyx);
+    # flush() then sends only the cells that changed since the last frame,
+    # one addstr per run of adjacent changed cells with the same color.
+    # The border is drawn once, whenever the window size changes.
+    def __init__(self):
+        self.size = None
+        self.chars = []
+        self.colors = []
+        self.shown_chars = []
+        self.shown_colors = []
+
+        # stats for the last flush()
+        self.cells = 0  # cells written
+        self.bytes = 0  # encoded bytes passed to addstr
+        self.writes = 0 # addstr calls
+
+    def getmaxyx(self):
+        return (self.size[1], self.size[0])
+
+    # start a new frame in an empty back buffer, or with keep, in a copy
+    # of the frame shown, to draw only what changed over it
+    def begin(self, win, keep=False):
+        size = win.getmaxyx()[::-1]
+        n = size[0] * size[1]
+        if size != self.size:
+            self.size = size
+            win.erase()
+            win.box()
+            self.shown_chars = [' '] * n
+            self.shown_colors = [0] * n
+        if keep:
+            self.chars = self.shown_chars[:]
+            self.colors = self.shown_colors[:]
+        else:
+            self.chars = [' '] * n
+            self.colors = [0] * n
+
+    def addstr(self, y, x, string, color=0):
+        (w, h) = self.size
+        # the border and anything past the window edge is left alone
+        if y < 1 or y >= h - 1:
+            return
+        i = y * w
+        for c in string:
+            if 1 <= x < w - 1:
+                self.chars[i + x] = c
+                self.colors[i + x] = color
+            x += 1
+
+    # write the changes since the last flush to win
+    def flush(self, win):
+        (w, h) = self.size
+        chars = self.chars
+        colors = self.colors
+        shown_chars = self.shown_chars
+        shown_colors = self.shown_colors
+        self.cells = self.bytes = self.writes = 0
+        for y in range(1, h - 1):
+            x = 1
+            while x < w - 1:
+                i = y * w + x
+                if chars[i] == shown_chars[i] and colors[i] == shown_colors[i]:
+                    x += 1
+                    continue
+                # extend the run while cells differ and the color matches
+                color = colors[i]
+                start = x
+                while x < w - 1:
+                    i = y * w + x
+                    if colors[i] != color or (chars[i] == shown_chars[i] and
+                            color == shown_colors[i]):
+                        break
+                    shown_chars[i] = chars[i]
+                    shown_colors[i] = color
+                    x += 1
+                run = "".join(chars[y * w + start:y * w + x])
+                win.addstr(y, start, run, color)
+                self.cells += x - start
+                self.bytes += len(run.encode("utf-8"))
+                self.writes += 1
+
+    # (cells, bytes) a full redraw of the frame would send, to compare
+    # with the diff's
+    def redraw_cost(self):
+        (w, h) = self.size
+        chars = self.chars
+        return ((w - 2) * (h - 2), sum(len("".join(
+            chars[y * w + 1:y * w + w - 1]).encode("utf-8"))
+            for y in range(1, h - 1)))
+
+class NullWindow:
+    # A window that shows nothing, to render into a Screen without a
+    # terminal (headless runs)
+    def __init__(self, w=80, h=24):
+        self.size = (w, h)
+
+    def getmaxyx(self):
+        return (self.size[1], self.size[0])
+
+    def addstr(self, y, x, string, color=0):
+        pass
+
+    def erase(self):
+        pass
+
+    def box(self):
+        pass
+
+class Scheduler:
+    # Frame timing against a monotonic clock.  Simulation steps are due
+    # every 1/rate seconds; after a stall at most max_steps are run back to
+    # back and the rest of the backlog is dropped (counted in skipped).
+    # Renders are separate: only when something changed (dirty) and at
+    # most render_rate times per second.  wait() tells how long the
+    # front-end may sleep (or wait for input) before the next deadline.
+    def __init__(self, rate=15.0, render_rate=15.0, max_steps=4,
+            clock=time.monotonic):
+        self.dt = 1.0 / rate
+        self.render_interval = 1.0 / render_rate
+        self.max_steps = max_steps
+        self.clock = clock
+        self.next_step = self.next_render = clock()
+        self.dirty = True
+        self.skipped = 0
+
+    # number of simulation steps (of dt seconds each) due now
+    def steps(self):
+        now = self.clock()
+        n = 0
+        while self.next_step <= now and n < self.max_steps:
+            self.next_step += self.dt
+            n += 1
+        if self.next_step <= now:
+            behind = int((now - self.next_step) / self.dt) + 1
+            self.skipped += behind
+            self.next_step += behind * self.dt
+        return n
+
+    def render_due(self):
+        return self.dirty and self.next_render <= self.clock()
+
+    def rendered(self):
+        self.dirty = False
+        self.next_render = max(self.next_render + self.render_interval,
+            self.clock() - self.render_interval)
+
+    # seconds until the next step or render is due
+    def wait(self):
+        deadline = self.next_step
+        if self.dirty:
+            deadline = min(deadline, self.next_render)
+        return max(0.0, deadline - self.clock())
+
+def main(win, options):
     curses.curs_set(0)
     
     while True:
-        msg = game(win)
+        msg = game(win, options)
         if not msg:
             break
         
@@ -614,90 +2680,250 @@ def main(win):
         elif op == ord('r'):
             continue
 
-def interface_logic(win, player):
+# key -> Simulation command
+KEYS = {
+    ord('i'): 'up',
+    ord('k'): 'down',
+    ord('j'): 'left',
+    ord('l'): 'right',
+    ord(' '): 'swing',
+}
+if curses:
+    KEYS.update({
+        curses.KEY_UP: 'up',
+        curses.KEY_DOWN: 'down',
+        curses.KEY_LEFT: 'left',
+        curses.KEY_RIGHT: 'right',
+    })
+
+# playing: keys are commands to the player (not while watching a replay)
+def interface_logic(win, sim, playing=True):
     ch = win.getch()
     if ch == ord('q'):
         return False
+    if ch == -1: # no input
+        return True
     
     # interface logic
-    if ch == ord('i') or ch == curses.KEY_UP:
-        player.try_move(0,-1)
-    elif ch == ord('k') or ch == curses.KEY_DOWN:
-        player.try_move(0,1)
-    elif ch == ord('j') or ch == curses.KEY_LEFT:
-        player.try_move(-1,0)
-    elif ch == ord('l') or ch == curses.KEY_RIGHT:
-        player.try_move(1,0)
-    elif ch == ord(' '):
-        player.swing()
+    cmd = KEYS.get(ch)
+    if cmd:
+        if playing:
+            sim.command(cmd)
+    elif ch == ord('p'):
+        sim.world.profiler.toggle()
+    elif ch == ord('P'):
+        sim.world.profiler.dump()
     return True
 
+# profiler overlay, top left
+def profiler_render(win, profiler):
+    if not profiler.enabled:
+        return
+    for (i, line) in enumerate(profiler.lines()):
+        win.addstr(1 + i, 2, " %s " % line, color_pair(12))
+
+# the map around player, centered in win
+def view_render(win, player):
+    (camera, view) = view_rect(win, player)
+    player.world.render(win, camera, view, view_visible(player, view))
+
+# the cells player sees, as far as they fit in view (see view_rect)
+def view_visible(player, view):
+    return player.world.fov.visible(player.x, player.y, player.sight,
+        (view[2] // 2, view[3] // 2))
+
+# (camera, view) of view_render: the world position of the top left
+# corner, and the (x, y, w, h) of the view in win
+def view_rect(win, player):
+    # calculate view and camera values based on term size
+    win_sz = win.getmaxyx()[::-1] # window size (in chars)
+    
+    max_size = [60,20]
+    capped_size = [min(max_size[0],win_sz[0] - 2), min(max_size[1],win_sz[1] - 3)]
+    
+    view = [1, 1, capped_size[0], capped_size[1]] # (view x,y,w,h)
+    view[0] += win_sz[0]//2 - view[2]//2
+    view[1] += win_sz[1]//2 - view[3]//2
+
+    # x,y position where to start rendering our map
+    camera = [player.x - view[2]//2, player.y - view[3]//2]
+    return (camera, view)
+
+# what hud_render shows, to tell if it changed
+def hud_state(player):
+    return (player.thinking(), player.world.name,
+        int(player.world.progress() * 100.0), player.gold, player.hp)
+
 def hud_render(win, player):
     win_sz = win.getmaxyx()[::-1]
     
     t = player.thinking()
     if t:
         ft = " %s " % t 
-        win.addstr(2, 1 + win_sz[0]//2 - len(t)//2, ft, curses.color_pair(11))
-    win.addstr(win_sz[1]-2, 1, player.world.name)
+        win.addstr(2, 1 + win_sz[0]//2 - len(t)//2, ft, color_pair(11))
+    name = player.world.name
+    progress = player.world.progress()
+    if progress < 1.0:
+        name += " (generating: %d%%)" % (progress * 100.0)
+    win.addstr(win_sz[1]-2, 1, name)
     status = "Gold: %s | HP %s / 100" % (player.gold, player.hp)
     win.addstr(win_sz[1]-2, win_sz[0]-len(status)-1, status)
 
-def game(win):
-    win_sz = win.getmaxyx()[::-1]
-    win.clear()
-    win.box()
-    
-    text = "Loading..."
-    win.addstr(win_sz[1]//2, win_sz[0]//2 - len(text)//2, text)
-    win.refresh()
-    
-    PLAYER = Glyph('player', 'v', 1)
-    curses.init_pair(1, curses.COLOR_BLACK, curses.COLOR_WHITE)
+class Simulation:
+    # A world and its player, advanced in steps of t seconds with no
+    # terminal involved.  Input is given as commands (see MOVES and
+    # command()), so it can come from the keyboard, a script or a bot.
+    # More players can join (add_player), e.g. for a server; commands go
+    # to the first one unless another is given.  A Recorder set as
+    # recorder logs the commands and steps, see Replay.
+
+    MOVES = {
+        'up': (0,-1),
+        'down': (0,1),
+        'left': (-1,0),
+        'right': (1,0),
+    }
+
+    def __init__(self, world, player):
+        self.world = world
+        self.player = player
+        self.players = []
+        self.frame = 0
+        self.recorder = None
+
+        # objects further than this from every player (in cells) sleep
+        self.radius = 48
+
+        # monsters within this many cells of a player hunt it, along one
+        # field leading to every player.  Only the prototype's can_pass is
+        # used
+        self.hunt_radius = 10
+        monster = Monster("monster", player.glyph, world)
+        world.flow_field = FlowField(world, [], monster.can_pass,
+            self.hunt_radius)
+        self.join(player)
+
+    def join(self, player):
+        self.players.append(player)
+        self.world.flow_field.targets.append(player)
+        # room for two fields of view (as rendered) per player, so
+        # stepping back to the last cell is a cache hit
+        fov = self.world.fov
+        fov.size = max(fov.size, 2 * len(self.players))
+
+    # a new player, placed at random
+    def add_player(self, name="Player"):
+        player = Player(name, self.world.glyph('player'), self.world)
+        with self.world.lock:
+            player.random_teleport()
+        self.join(player)
+        return player
+
+    def remove_player(self, player):
+        player.detach()
+        self.players.remove(player)
+        self.world.flow_field.targets.remove(player)
+
+    def command(self, cmd, player=None):
+        player = player or self.player
+        if self.recorder:
+            self.recorder.command(self.players.index(player), cmd)
+        with self.world.lock:
+            self.world.version += 1 # e.g. the player turned, even if it didn't move
+            if cmd in self.MOVES:
+                player.try_move(*self.MOVES[cmd])
+            elif cmd == 'swing':
+                player.swing()
+            elif cmd == 'shoot':
+                player.shoot()
+            elif cmd == 'respawn':
+                player.respawn()
+            else:
+                assert False, "unknown command: %s" % cmd
+
+    # apply commands, then advance the world by t seconds
+    def step(self, t, commands=()):
+        for cmd in commands:
+            self.command(cmd)
+        self.world.profiler.mark("input")
+        
+        # object logic, player included
+        with self.world.lock:
+            self.world.prune()
+            self.world.simulate(t, [(p.x, p.y) for p in self.players],
+                self.radius)
+            self.world.profiler.mark("tick")
+            self.frame += 1
+            if self.recorder:
+                self.recorder.step(self, t)
+
+    # step frames times, script (opt) maps frame numbers to command lists
+    def run(self, frames, t, script=None):
+        for i in range(frames):
+            self.step(t, script.get(self.frame, ()) if script else ())
+            if self.over():
+                break
+
+    # reason the game ended, "" while it is still going
+    def over(self):
+        if self.player.hp <= 0:
+            return "You are dead."
+        return ""
+
+# build "The Forest", returns a Simulation.  Doesn't need curses, but glyph
+# colors refer to the pairs set up by init_colors().  With population, the
+# monsters are kept in a Population instead of being separate objects.
+# chunked: generate an unbounded ChunkedMap as it is explored (w and h then
+#   only bound where the player starts)
+# staged: generate a StagedMap, around the player first and the rest in the
+#   background (not with population, which is sprinkled over the whole map)
+def build_world(seed=None, w=300, h=300, population=False, chunked=False,
+        staged=False):
     GRASS = Glyph('grass', '.',2,plural=True)
-    curses.init_pair(2, curses.COLOR_GREEN, curses.COLOR_BLACK)
-    world = Map("The Forest", 300, 300, GRASS)
-    
+    if chunked:
+        world = ChunkedMap("The Forest", w, h, GRASS, seed=seed)
+    elif staged:
+        assert not population, "populations need the whole map generated"
+        world = StagedMap("The Forest", w, h, GRASS, seed=seed)
+    else:
+        world = Map("The Forest", w, h, GRASS, seed=seed)
+    forest(world, population)
+
+    player = Player("Player", world.glyph('player'), world)
+    player.random_teleport()
+
+    sim = Simulation(world, player)
+    if staged:
+        world.start(player.x, player.y, sim.radius + world.chunk_size)
+    return sim
+
+# the glyphs, tiles and inhabitants of the forest, sprinkled over world
+def forest(world, population=False):
+    world.glyph('player', 'v', 1) # facing down, see Player.turns
     BUSH = world.glyph('bush', '*', 3)
-    curses.init_pair(3, curses.COLOR_GREEN, curses.COLOR_BLACK)
-    
     ROCK = world.glyph('rock', 'o', 4)
-    curses.init_pair(4, curses.COLOR_WHITE, curses.COLOR_BLACK)
-    
     TREE = world.glyph('tree', 'T', 5)
-    curses.init_pair(5, curses.COLOR_GREEN, curses.COLOR_BLACK)
-
     MONSTER = world.glyph('monster', "M", 6)
-    curses.init_pair(6, curses.COLOR_RED, curses.COLOR_BLACK)
-
     GOLD = world.glyph('gold', '*', 7)
-    curses.init_pair(7, curses.COLOR_YELLOW, curses.COLOR_BLACK)
-
     HEALTH = world.glyph('health', "+", 8)
-    curses.init_pair(8, curses.COLOR_RED, curses.COLOR_WHITE)
-
     BULLET = world.glyph('bullet', "\'", 9)
-    curses.init_pair(9, curses.COLOR_RED, curses.COLOR_BLACK)
 
     SWORD = world.glyph('\\', "\\", 10)
     world.glyph('|', "|", 10)
     world.glyph('-', "-", 10)
     world.glyph('/', "/", 10)
-    curses.init_pair(10, curses.COLOR_WHITE, curses.COLOR_BLACK)
 
     DOOR_H = world.glyph('door_h', '-', 4)
     DOOR_V = world.glyph('door_v', '|', 4)
     WALL = world.glyph('wall', 'H', 4)
     FENCE = world.glyph('fence', '#', 4)
     
-    curses.init_pair(11, curses.COLOR_RED, curses.COLOR_BLACK)
     NOTHING = world.glyph('nothing', 'X',11)
 
     world.sprinkle(ROCK, 0.01, solid=True)
     world.sprinkle(BUSH, 0.02, conceal=True)
     world.sprinkle(TREE, 0.02, solid=True)
     
-    curses.init_pair(12, curses.COLOR_YELLOW, curses.COLOR_BLACK)
     #world.structure(
     #    theme="inside"
     #    wall=WALL,
@@ -705,10 +2931,15 @@ def game(win):
     #    flor=[FLOOR]
     #)
 
-    world.sprinkle(
-        lambda **kwargs: Monster("monster", MONSTER, world, speed=random.random()*2.0, **kwargs),
-        0.01
-    )
+    if population:
+        monsters = Population(world,
+            lambda **kwargs: Monster("monster", MONSTER, world, **kwargs))
+        monsters.sprinkle(0.01, lambda: world.random.random()*2.0)
+    else:
+        world.sprinkle(
+            lambda **kwargs: Monster("monster", MONSTER, world, speed=world.random.random()*2.0, **kwargs),
+            0.01
+        )
     world.sprinkle(
         lambda **kwargs: Item("gold coin", GOLD, world, **kwargs),
         0.001
@@ -717,85 +2948,755 @@ def game(win):
         lambda **kwargs: Item("health kit", HEALTH, world, **kwargs),
         0.0001
     )
+    register_factories(world)
+
+# glyphs and factories (by name) of what appears during play
+def register_factories(world):
+    pair = world.glyph('player').pair
+    world.glyph('player_up', '^', pair)
+    world.glyph('player_left', '<', pair)
+    world.glyph('player_right', '>', pair)
     world.register_object_factory(
         "bullet",
-        lambda **kwargs: Bullet("bullet", BULLET, world, **kwargs)
+        lambda **kwargs: Bullet("bullet", world.glyph('bullet'), world, **kwargs),
+        pool=True
     )
     world.register_object_factory(
         "sword",
-        lambda **kwargs: Sword("sword", SWORD, world, **kwargs)
+        lambda **kwargs: Sword("sword", world.glyph('\\'), world, **kwargs),
+        pool=True
     )
 
-    player = Player("Player", copy.deepcopy(PLAYER), world)
-    player.random_teleport()
+# World snapshots, a little-endian binary file:
+#   header (SNAPSHOT_HEADER), then
+#   strings: length (u16) + utf-8 each; records refer to them by number
+#   glyphs, tile kinds, objects (by chunk): fixed-size records
+#   populations: a record, then the member x, y and speed arrays each
+#   the state of world.random
+#   chunk times: the time each chunk was last simulated to (see
+#     Map.simulate), a record each
+#   for a StagedMap not fully generated: a byte per chunk, set if it is
+#     (the others are generated again, from the seed, once loaded)
+#   the tile grid, one u16 tile id per cell, at grid_offset (8-aligned)
+# load_world() maps the grid straight from the file instead of reading it.
+# Version 1 files (without chunk times and ready chunks) and version 2
+# files (without animation frames in the objects) still load.
+SNAPSHOT_MAGIC = b"CRSW"
+SNAPSHOT_VERSION = 3
+# magic, version, reserved, w, h, time, frame, counts of strings, glyphs,
+# tiles, objects, populations, chunk times and ready bytes (0 if the map is
+# all generated), StagedMap seed, grid offset
+SNAPSHOT_HEADER = struct.Struct("<4sHHIIdIIIIIIIIQQ")
+SNAPSHOT_HEADER_V1 = struct.Struct("<4sHHIIdIIIIIIQ")
+GLYPH_RECORD = struct.Struct("<IIHB")       # name, string, pair, flags
+TILE_RECORD = struct.Struct("<IIIB")        # glyph, name, theme, flags
+# class, name, glyph, flags, dir x, dir y, x, y, vx, vy, speed, hp, gold,
+# animation frame and seconds to the next (swords)
+OBJECT_RECORD = struct.Struct("<IIIBbbdddddiiHd")
+OBJECT_RECORD_V2 = struct.Struct("<IIIBbbdddddii")
+POPULATION_RECORD = struct.Struct("<IIII")  # class, name, glyph, members
+RANDOM_STATE = struct.Struct("<625Id")
+CHUNK_RECORD = struct.Struct("<IId")        # chunk x, chunk y, time
+
+GLYPH_PLURAL, GLYPH_REGISTERED = 1, 2
+TILE_SOLID, TILE_PLURAL, TILE_CONCEAL, TILE_OBVIOUS = 1, 2, 4, 8
+OBJECT_FLOAT, OBJECT_OBVIOUS, OBJECT_PLURAL, OBJECT_PLAYER = 1, 2, 4, 8
+
+# classes objects are restored as, by name
+object_classes = dict((T.__name__, T)
+    for T in (Object, Player, Sword, Bullet, Item, Monster))
+
+# the OBJECT_RECORD of obj, with the ids sid and gid give its strings and
+# glyphs
+def pack_object(obj, sid, gid, player=False):
+    flags = ((isinstance(obj.x, float) and OBJECT_FLOAT) |
+        (obj.obvious and OBJECT_OBVIOUS) | (obj.plural and OBJECT_PLURAL) |
+        (player and OBJECT_PLAYER))
+    (dx, dy) = getattr(obj, "dir", (0, 0))
+    (frame, left) = (0, 0.0)
+    if isinstance(obj, Sword):
+        (frame, left) = (obj.frame, obj.left())
+    return OBJECT_RECORD.pack(sid(obj.__class__.__name__), sid(obj.name),
+        gid(obj.glyph), flags, dx, dy, obj.x, obj.y, obj.vx, obj.vy,
+        getattr(obj, "speed", 0.0), getattr(obj, "hp", 0),
+        getattr(obj, "gold", 0), frame, left)
+
+# (object, player flag) of an unpacked OBJECT_RECORD (or OBJECT_RECORD_V2),
+# whose ids refer to strings and glyphs.  The object is new and not
+# attached yet.
+def unpack_object(world, record, strings, glyphs):
+    (cls, name, glyph, flags, dx, dy, x, y, vx, vy, speed, hp, gold) = \
+        record[:13]
+    if not flags & OBJECT_FLOAT:
+        (x, y) = (int(x), int(y))
+    obj = object_classes[strings[cls]](strings[name], glyphs[glyph], world,
+        pos=(x, y), vel=(vx, vy))
+    for (attr, value) in (("speed", speed), ("hp", hp), ("gold", gold)):
+        if hasattr(obj, attr):
+            setattr(obj, attr, value)
+    if flags & OBJECT_PLAYER:
+        obj.dir = [dx, dy]
+    if isinstance(obj, Sword) and len(record) > 13:
+        obj.resume(*record[13:])
+    return (obj, bool(flags & OBJECT_PLAYER))
+
+# The parts of a snapshot file of sim (bytes objects, to be written in
+# order).  Everything is copied, so they can be written out while the
+# game goes on.  A StagedMap is saved as far as it is generated, holding
+# its lock so that no chunk is half made.
+def snapshot(sim):
+    world = sim.world
+    assert world.grid is not None, "snapshots need a fixed-size Map"
+    with world.lock:
+        return snapshot_parts(sim)
+
+def snapshot_parts(sim):
+    world = sim.world
+    strings = {}
+    def sid(string):
+        i = strings.get(string)
+        if i is None:
+            i = strings[string] = len(strings)
+        return i
+    glyphs = {} # id -> (number, glyph)
+    def gid(glyph):
+        g = glyphs.get(id(glyph))
+        if g is None:
+            g = glyphs[id(glyph)] = (len(glyphs), glyph)
+        return g[0]
+
+    sid(world.name)
+    registered = set(id(g) for g in world.glyphs.values())
+    for g in world.glyphs.values():
+        gid(g)
+    tiles = [TILE_RECORD.pack(gid(t.glyph), sid(t.name), sid(t.theme),
+        (t.solid and TILE_SOLID) | (t.plural and TILE_PLURAL) |
+        (t.conceal and TILE_CONCEAL) | (t.obvious and TILE_OBVIOUS))
+        for t in world.tiles]
+
+    # in the order of the chunk buckets, which is the order they tick in
+    objects = [pack_object(obj, sid, gid, obj is sim.player)
+        for bucket in world.chunks.values() for obj in bucket
+        if obj.attached()]
+
+    pops = []
+    for pop in world.populations:
+        slots = list(pop.at.values())
+        pops.append(POPULATION_RECORD.pack(
+            sid(pop.prototype.__class__.__name__), sid(pop.name),
+            gid(pop.glyph), len(slots)))
+        for values in (pop.x, pop.y, pop.speed):
+            pops.append(array.array(values.typecode,
+                [values[slot] for slot in slots]).tobytes())
+
+    glyph_records = [GLYPH_RECORD.pack(sid(g.name), sid(g.string), g.pair,
+        (g.plural and GLYPH_PLURAL) | (id(g) in registered and GLYPH_REGISTERED))
+        for (i, g) in sorted(glyphs.values(), key=lambda g: g[0])]
+    (version, state, gauss) = world.random.getstate()
+    body = [b"".join(struct.pack("<H", len(b)) + b
+        for b in (string.encode("utf-8") for string in strings))]
+    body += glyph_records + tiles + objects + pops
+    body.append(RANDOM_STATE.pack(*(state +
+        (float("nan") if gauss is None else gauss,))))
+    body += [CHUNK_RECORD.pack(cx, cy, t)
+        for ((cx, cy), t) in sorted(world.chunk_time.items())]
+    (ready, seed) = (b"", 0)
+    if getattr(world, "pending", 0):
+        (ready, seed) = (bytes(world.ready), world.seed)
+        body.append(ready)
+
+    grid = world.grid
+    if sys.byteorder != "little":
+        grid = array.array('H', grid)
+        grid.byteswap()
+    size = SNAPSHOT_HEADER.size + sum(len(b) for b in body)
+    pad = b"\0" * (-size % 8)
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0,
+        world.w, world.h, world.time, sim.frame, len(strings), len(glyphs),
+        len(world.tiles), len(objects), len(world.populations),
+        len(world.chunk_time), len(ready), seed, size + len(pad))
+    return [header] + body + [pad, bytes(grid)]
+
+# write snapshot parts to path, replacing it only once they are all written
+def write_snapshot(parts, path):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        for part in parts:
+            f.write(part)
+    os.replace(tmp, path)
+
+def save_world(sim, path):
+    write_snapshot(snapshot(sim), path)
+
+# Simulation restored from a snapshot file.  The grid is a copy-on-write
+# memory map of the file: tiles are paged in as they are read, and
+# changes stay in memory.  A StagedMap saved before it was all generated
+# comes back as one (with the rules of the forest, see build_world) and
+# generates the rest in the background again.
+def load_world(path):
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    (magic, version) = struct.unpack_from("<4sH", data, 0)
+    assert magic == SNAPSHOT_MAGIC, "not a world snapshot: %s" % path
+    assert version in (1, 2, SNAPSHOT_VERSION), \
+        "unsupported snapshot version %d" % version
+    if version == 1:
+        header = SNAPSHOT_HEADER_V1
+        (magic, version, reserved, w, h, time_, frame, n_strings, n_glyphs,
+            n_tiles, n_objects, n_pops, grid_offset) = \
+            header.unpack_from(data, 0)
+        (n_chunks, n_ready, seed) = (0, 0, 0)
+    else:
+        header = SNAPSHOT_HEADER
+        (magic, version, reserved, w, h, time_, frame, n_strings, n_glyphs,
+            n_tiles, n_objects, n_pops, n_chunks, n_ready, seed,
+            grid_offset) = header.unpack_from(data, 0)
+    pos = header.size
+
+    strings = []
+    for i in range(n_strings):
+        (n,) = struct.unpack_from("<H", data, pos)
+        strings.append(data[pos + 2:pos + 2 + n].decode("utf-8"))
+        pos += 2 + n
+    def records(fmt, count):
+        r = [fmt.unpack_from(data, pos + i * fmt.size) for i in range(count)]
+        return (r, pos + count * fmt.size)
+
+    (rs, pos) = records(GLYPH_RECORD, n_glyphs)
+    glyphs = [Glyph(strings[name], strings[string], pair,
+        plural=bool(flags & GLYPH_PLURAL)) for (name, string, pair, flags) in rs]
+    (tile_rs, pos) = records(TILE_RECORD, n_tiles)
+
+    # the map without a grid of its own, then the saved tile kinds
+    if n_ready:
+        world = StagedMap(strings[0], 0, 0, glyphs[tile_rs[0][0]], seed=seed)
+        forest(world)
+        # the rules refer to the registered glyphs and the first tile ids
+        rule_tiles = [world.tiles[tid].glyph.name
+            for (tid, freq) in world.tile_rules]
+        glyphs = [world.glyphs.get(g.name, g) if flags & GLYPH_REGISTERED
+            else g for (g, (name, string, pair, flags)) in zip(glyphs, rs)]
+    else:
+        world = Map(strings[0], 0, 0, glyphs[tile_rs[0][0]])
+    (world.w, world.h) = (w, h)
+    world.time = time_
+    # alarms set from now on are due after time_, not walked to from 0
+    world.timers.tick = int(time_ / world.timers.resolution + 1e-9)
+    world.glyphs.clear()
+    for (g, (name, string, pair, flags)) in zip(glyphs, rs):
+        if flags & GLYPH_REGISTERED:
+            world.glyphs[g.name] = g
+    world.nothing_glyph = world.glyphs.get('nothing')
+    (world.tiles, world.tile_ids) = ([], {})
+    for (glyph, name, theme, flags) in tile_rs:
+        world.tile_id(Tile(glyphs[glyph], name=strings[name],
+            theme=strings[theme], solid=bool(flags & TILE_SOLID),
+            plural=bool(flags & TILE_PLURAL),
+            conceal=bool(flags & TILE_CONCEAL),
+            obvious=bool(flags & TILE_OBVIOUS)))
+    grid = memoryview(data)[grid_offset:grid_offset + w * h * 2]
+    if sys.byteorder != "little":
+        grid = array.array('H', grid)
+        grid.byteswap()
+    world.grid = grid.cast('H') if isinstance(grid, memoryview) else grid
+    if n_ready:
+        assert rule_tiles == [world.tiles[tid].glyph.name
+            for (tid, freq) in world.tile_rules], "not a forest: %s" % path
+    else:
+        register_factories(world)
+
+    (rs, pos) = records(OBJECT_RECORD if version >= 3 else OBJECT_RECORD_V2,
+        n_objects)
+    player = None
+    for record in rs:
+        (obj, is_player) = unpack_object(world, record, strings, glyphs)
+        if is_player:
+            player = obj
+        else:
+            # swords and bullets go back to their pools like spawned ones
+            obj.pool = world.pools.get(obj.name)
+            world.ensure_object(obj)
+        obj.attach()
+
+    for i in range(n_pops):
+        (cls, name, glyph, count) = POPULATION_RECORD.unpack_from(data, pos)
+        pos += POPULATION_RECORD.size
+        (cls, glyph) = (object_classes[strings[cls]], glyphs[glyph])
+        pop = Population(world, lambda cls=cls, name=strings[name],
+            glyph=glyph, **kwargs: cls(name, glyph, world, **kwargs))
+        values = []
+        for typecode in "iid":
+            a = array.array(typecode)
+            a.frombytes(data[pos:pos + count * a.itemsize])
+            if sys.byteorder != "little":
+                a.byteswap()
+            values.append(a)
+            pos += count * a.itemsize
+        for (x, y, speed) in zip(*values):
+            pop.add(x, y, speed)
+
+    state = RANDOM_STATE.unpack_from(data, pos)
+    gauss = state[-1]
+    world.random.setstate((3, state[:-1], None if gauss != gauss else gauss))
+    pos += RANDOM_STATE.size
+
+    (rs, pos) = records(CHUNK_RECORD, n_chunks)
+    world.chunk_time = dict(((cx, cy), t) for (cx, cy, t) in rs)
+    if version == 1:
+        # not saved: as if every chunk had just been simulated
+        world.chunk_time = dict((key, world.time) for key in world.chunks)
+
+    sim = Simulation(world, player)
+    sim.frame = frame
+    if n_ready:
+        cs = world.chunk_size
+        world.columns = (w + cs - 1) // cs
+        world.rows = (h + cs - 1) // cs
+        world.ready = bytearray(data[pos:pos + n_ready])
+        world.pending = world.ready.count(0)
+        world.start(player.x, player.y, sim.radius + cs)
+    return sim
+
+class Autosaver:
+    # Saves sim to path every interval seconds (of wall time) from a
+    # background thread.  The snapshot is taken in the game loop (a copy
+    # of the grid and the packed objects), only writing it happens in
+    # the thread, so a save of the default world costs the loop about a
+    # millisecond.  A save
+    # still being written when the next one is due delays that one.
+    def __init__(self, sim, path, interval=30.0, clock=time.monotonic):
+        self.sim = sim
+        self.path = path
+        self.interval = interval
+        self.clock = clock
+        self.last = clock()
+        self.thread = None
+        self.saves = 0
+
+    def tick(self):
+        if self.clock() - self.last >= self.interval:
+            self.save()
+
+    def save(self):
+        if self.thread and self.thread.is_alive():
+            return False
+        self.last = self.clock()
+        self.thread = threading.Thread(target=write_snapshot,
+            args=(snapshot(self.sim), self.path))
+        self.thread.daemon = True
+        self.thread.start()
+        self.saves += 1
+        return True
 
-    camera = [0,0]
-    
-    win.nodelay(1)
+    # wait for the save in progress, if any
+    def join(self):
+        if self.thread:
+            self.thread.join()
+
+# Replay logs, a little-endian binary file appended to as the game goes:
+#   header (REPLAY_HEADER): what build_world() needs to make the world
+#   then records, each a tag byte and its fields:
+#     T dt (f64)               the steps from now on are dt seconds long
+#     C player (u8), cmd (u8)  Simulation.command(COMMANDS[cmd]) for
+#                              sim.players[player]
+#     S                        Simulation.step(dt)
+#     H frame (u32), hash (u64) state_hash() after that frame's step
+# A log cut short (the game crashed) replays up to its last whole record.
+REPLAY_MAGIC = b"CRSR"
+REPLAY_VERSION = 1
+# magic, version, flags, seed, w, h
+REPLAY_HEADER = struct.Struct("<4sHHqII")
+REPLAY_POPULATION = 1
+REPLAY_CHUNKED = 2
+REPLAY_STAGED = 4
+REPLAY_DT = struct.Struct("<d")
+REPLAY_COMMAND = struct.Struct("<BB")
+REPLAY_HASH = struct.Struct("<IQ")
+
+# commands, by their number in replay logs
+COMMANDS = ('up', 'down', 'left', 'right', 'swing', 'shoot', 'respawn')
+
+# A digest of the state of sim that replays have to reproduce: the frame,
+# the simulation time, the players, the positions of the objects in the
+# chunks simulated so far, the members of populations and the state of
+# world.random.  Objects elsewhere are left out, as what is there depends
+# on how far a background thread got (see StagedMap).
+def state_hash(sim):
+    world = sim.world
+    h = hashlib.blake2b(digest_size=8)
+    h.update(struct.pack("<Id", sim.frame, world.time))
+    for p in sim.players:
+        h.update(struct.pack("<ddii", p.x, p.y, p.hp, p.gold))
+    coords = array.array('d')
+    for key in sorted(world.chunk_time):
+        for (x, y) in sorted((obj.x, obj.y)
+                for obj in world.chunks.get(key, ())):
+            coords.append(x)
+            coords.append(y)
+    h.update(coords)
+    for pop in world.populations:
+        h.update(pop.x)
+        h.update(pop.y)
+        h.update(pop.alive)
+    h.update(array.array('Q', world.random.getstate()[1]))
+    return struct.unpack("<Q", h.digest())[0]
+
+class Recorder:
+    # Writes the log of sim to path: made with the arguments sim was built
+    # with, then set as sim.recorder, which tells it every command and
+    # step.  A state hash is written every interval frames.  Every step
+    # is flushed out as it is logged.
+    def __init__(self, path, sim, seed, population=False, chunked=False,
+            staged=False, interval=60):
+        self.file = open(path, "wb")
+        self.interval = interval
+        self.dt = None
+        flags = ((population and REPLAY_POPULATION) |
+            (chunked and REPLAY_CHUNKED) | (staged and REPLAY_STAGED))
+        self.file.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION,
+            flags, seed, sim.world.w, sim.world.h))
+
+    def command(self, player, cmd):
+        self.file.write(b"C" + REPLAY_COMMAND.pack(player, COMMANDS.index(cmd)))
+
+    def step(self, sim, t):
+        if t != self.dt:
+            self.dt = t
+            self.file.write(b"T" + REPLAY_DT.pack(t))
+        self.file.write(b"S")
+        if sim.frame % self.interval == 0:
+            self.file.write(b"H" + REPLAY_HASH.pack(sim.frame,
+                state_hash(sim)))
+        self.file.flush() # a crash loses nothing before it
+
+    def close(self):
+        self.file.close()
+
+class Replay:
+    # Plays the log at path back: sim is built like the recorded one was,
+    # then step() applies the logged commands through Simulation.command
+    # and steps it like it was.  The recorded state hashes are checked on
+    # the way; diverged is the first frame that didn't match, or None.
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = f.read()
+        (magic, version, flags, seed, w, h) = \
+            REPLAY_HEADER.unpack_from(self.data, 0)
+        assert magic == REPLAY_MAGIC, "not a replay log: %s" % path
+        assert version == REPLAY_VERSION, \
+            "replay log version %d, expected %d" % (version, REPLAY_VERSION)
+        self.sim = build_world(seed, w, h, bool(flags & REPLAY_POPULATION),
+            bool(flags & REPLAY_CHUNKED), bool(flags & REPLAY_STAGED))
+        self.pos = REPLAY_HEADER.size
+        self.dt = 1.0 / 15.0
+        self.checked = 0
+        self.diverged = None
+
+    # run the log up to the next step and take it, False at its end
+    def step(self):
+        data = self.data
+        sim = self.sim
+        while self.pos < len(data):
+            tag = data[self.pos:self.pos + 1]
+            pos = self.pos + 1
+            if tag == b"S":
+                self.pos = pos
+                sim.step(self.dt)
+                return True
+            record = {b"T": REPLAY_DT, b"C": REPLAY_COMMAND,
+                b"H": REPLAY_HASH}[tag]
+            if pos + record.size > len(data):
+                break
+            fields = record.unpack_from(data, pos)
+            self.pos = pos + record.size
+            if tag == b"T":
+                self.dt = fields[0]
+            elif tag == b"C":
+                sim.command(COMMANDS[fields[1]], sim.players[fields[0]])
+            else:
+                self.checked += 1
+                if self.diverged is None and (fields[0] != sim.frame or
+                        fields[1] != state_hash(sim)):
+                    self.diverged = fields[0]
+        self.pos = len(data)
+        return False
+
+# a new Simulation for options (w by w cells), recorded with --record.
+# staged: generated in the background if it can be (see build_world)
+def new_world(options, w=300, staged=False):
+    if options.record and options.seed is None:
+        options.seed = random.getrandbits(32) # a replay needs the seed
+    staged = staged and not (options.population or options.chunked)
+    sim = build_world(options.seed, w, w, options.population,
+        options.chunked, staged)
+    if options.record:
+        sim.recorder = Recorder(options.record, sim, options.seed,
+            options.population, options.chunked, staged)
+    return sim
+
+def init_colors():
+    curses.init_pair(1, curses.COLOR_BLACK, curses.COLOR_WHITE)
+    curses.init_pair(2, curses.COLOR_GREEN, curses.COLOR_BLACK)
+    curses.init_pair(3, curses.COLOR_GREEN, curses.COLOR_BLACK)
+    curses.init_pair(4, curses.COLOR_WHITE, curses.COLOR_BLACK)
+    curses.init_pair(5, curses.COLOR_GREEN, curses.COLOR_BLACK)
+    curses.init_pair(6, curses.COLOR_RED, curses.COLOR_BLACK)
+    curses.init_pair(7, curses.COLOR_YELLOW, curses.COLOR_BLACK)
+    curses.init_pair(8, curses.COLOR_RED, curses.COLOR_WHITE)
+    curses.init_pair(9, curses.COLOR_RED, curses.COLOR_BLACK)
+    curses.init_pair(10, curses.COLOR_WHITE, curses.COLOR_BLACK)
+    curses.init_pair(11, curses.COLOR_RED, curses.COLOR_BLACK)
+    curses.init_pair(12, curses.COLOR_YELLOW, curses.COLOR_BLACK)
+
+def game(win, options):
+    win_sz = win.getmaxyx()[::-1]
+    win.clear()
+    win.box()
     
-    # init timer
-    t0 = time.time()
-    accum = 0 # time accumulated since last tick
+    text = "Loading..."
+    win.addstr(win_sz[1]//2, win_sz[0]//2 - len(text)//2, text)
+    win.refresh()
     
-    FPS = 15.0
-    FPS_INV = 1.0 / FPS
+    init_colors()
+    replay = None
+    if options.replay:
+        replay = Replay(options.replay)
+        sim = replay.sim
+    elif options.load:
+        sim = load_world(options.load)
+    else:
+        sim = new_world(options, staged=True)
+    world = sim.world
+    player = sim.player
+    profiler = world.profiler
+    if options.profile:
+        profiler.path = options.profile
+        profiler.enabled = True
+
+    screen = Screen()
+    scheduler = Scheduler(options.rate, options.render_rate)
+    profiler.budget = scheduler.dt
+    version = None # world version last rendered
+    autosaver = None
+    if options.save:
+        autosaver = Autosaver(sim, options.save, options.autosave)
     
     while True:
         
-        # advance timer at a fixed framerate
-        advance = 0
-        while True:
-            t1 = time.time()
-            accum += t1 - t0
-            t0 = t1
-            if accum > FPS_INV:
-                advance = FPS_INV
-                accum = advance - accum # rollover excess time
-                break
-            time.sleep(0.001)
-        
-        # calculate view and camera values based on term size
-        win_sz = win.getmaxyx()[::-1] # window size (in chars)
-        
-        max_size = [60,20]
-        capped_size = [min(max_size[0],win_sz[0] - 2), min(max_size[1],win_sz[1] - 3)]
+        profiler.begin()
+
+        # catch up on simulation steps, at a fixed rate
+        for i in range(scheduler.steps()):
+            if not replay:
+                sim.step(scheduler.dt)
+            elif not replay.step():
+                if replay.diverged is not None:
+                    return "The replay diverged at frame %d." % replay.diverged
+                return "End of the replay."
         
-        view = [1, 1, capped_size[0], capped_size[1]] # (view x,y,w,h)
-        view[0] += win_sz[0]//2 - view[2]//2
-        view[1] += win_sz[1]//2 - view[3]//2
+            # game state termination
+            msg = sim.over()
+            if msg:
+                return msg
 
-        # x,y position where to start rendering our map
-        camera = [player.x - view[2]//2, player.y - view[3]//2]
-        
-        win.erase()
+            global msgs
+            if msgs:
+                return msgs
 
-        world.render(win, camera, view)
+        if autosaver:
+            autosaver.tick()
 
-        # draw HUD
-        hud_render(win, player)
-        
-        # draw border
-        win.box()
-        win.refresh()
-        
-        if not interface_logic(win, player):
-            return "" # user quit
-        
-        player.tick(advance)
+        if world.version != version or profiler.enabled:
+            scheduler.dirty = True
+
+        if scheduler.render_due():
+            version = world.version
 
-        # object logic
-        world.objects = list(filter(lambda obj: obj.attached(), world.objects))
-        for obj in world.objects:
-            obj.tick(advance)
+            screen.begin(win)
+            view_render(screen, player)
+            profiler.mark("render")
+
+            # draw HUD
+            hud_render(screen, player)
+            profiler_render(screen, profiler)
+            profiler.mark("hud")
+            
+            # send what changed (the border is drawn by screen.begin)
+            screen.flush(win)
+            profiler.flushed(screen)
+            win.refresh()
+            scheduler.rendered()
+            profiler.mark("flush")
         
-        # game state termination
-        if player.hp <= 0:
-            return "You are dead."
+        profiler.end()
+
+        # sleep until the next deadline, or until a key is pressed
+        win.timeout(int(math.ceil(scheduler.wait() * 1000.0)))
+        if not interface_logic(win, sim, not replay):
+            if options.profile:
+                profiler.dump()
+            if autosaver:
+                autosaver.join()
+                save_world(sim, options.save)
+            return "" # user quit
 
-        global msgs
-        if msgs:
-            return msgs
+# run the simulation without a terminal for the given number of frames and
+# report the tick rate
+def headless(frames, options):
+    t0 = time.time()
+    if options.load:
+        sim = load_world(options.load)
+    else:
+        sim = new_world(options, options.size, options.staged)
+    if options.profile:
+        sim.world.profiler.enabled = True
+    t1 = time.time()
+    profiler = sim.world.profiler
+    start = sim.frame
+    deaths = 0
+    generated = None # seconds until the whole map was generated
+    if options.render:
+        (screen, win) = (Screen(), NullWindow())
+        sent = [0, 0, 0, 0, 0] # as in Profiler.screen, totals
+    for i in range(frames):
+        profiler.begin()
+        sim.step(1.0 / 15.0)
+        if options.render:
+            screen.begin(win)
+            view_render(screen, sim.player)
+            hud_render(screen, sim.player)
+            profiler.mark("render")
+            screen.flush(win)
+            profiler.flushed(screen)
+            profiler.mark("flush")
+            for (j, n) in enumerate((screen.cells, screen.bytes,
+                    screen.writes) + screen.redraw_cost()):
+                sent[j] += n
+        profiler.end()
+        if generated is None and sim.world.progress() >= 1.0:
+            generated = time.time() - t1
+        if sim.over():
+            # the monsters got the (idle) player, keep going
+            deaths += 1
+            sim.command('respawn')
+    t2 = time.time()
+    print("built world in %.3fs, %d frames in %.3fs (%.0f frames/s)" % (
+        t1 - t0, sim.frame - start, t2 - t1,
+        (sim.frame - start) / max(t2 - t1, 1e-9)))
+    if deaths:
+        print("the player died %d times" % deaths)
+    if options.render:
+        n = float(max(frames, 1))
+        print("screen: %.0f cells, %.0f bytes in %.1f writes per frame "
+            "(a full redraw: %.0f cells, %.0f bytes)" % tuple(
+            total / n for total in sent))
+    if options.staged:
+        if generated is None:
+            print("map %.0f%% generated" % (sim.world.progress() * 100.0))
+        else:
+            print("map generated in the background in %.3fs" % generated)
+    for (name, stats) in sorted(sim.world.pool_report().items()):
+        print("%s pool: %d hits, %d misses, %d free" % (name, stats["hits"],
+            stats["misses"], stats["free"]))
+    print("events: %s" % ", ".join("%d %s" % (n, event)
+        for (event, n) in sorted(sim.world.events.counts.items())))
+    if options.chunked:
+        print("chunks: %(generated)d generated, %(evicted)d evicted, "
+            "%(saved)d saved, %(loaded)d loaded" % sim.world.stats)
+    if options.memory:
+        report = sim.world.memory_report()
+        for (part, n) in sorted(report.items(), key=lambda e: -e[1]):
+            print("%-14s %10d bytes" % (part, n))
+        print("%-14s %10d bytes, %.0f per object" % ("total",
+            sum(report.values()), report["objects"] /
+            max(len(sim.world.objects), 1)))
+    if options.profile:
+        profiler.dump(options.profile)
+    if options.save:
+        save_world(sim, options.save)
+    if sim.recorder:
+        sim.recorder.close()
+
+# replay the log at options.replay as fast as possible, without a terminal
+def fast_forward(options):
+    t0 = time.time()
+    replay = Replay(options.replay)
+    sim = replay.sim
+    profiler = sim.world.profiler
+    if options.profile:
+        profiler.enabled = True
+    t1 = time.time()
+    while True:
+        profiler.begin()
+        stepped = replay.step()
+        profiler.end()
+        if not stepped:
+            break
+    t2 = time.time()
+    print("built world in %.3fs, %d frames in %.3fs (%.0f frames/s)" % (
+        t1 - t0, sim.frame, t2 - t1, sim.frame / max(t2 - t1, 1e-9)))
+    if replay.diverged is not None:
+        print("diverged at frame %d" % replay.diverged)
+    else:
+        print("%d state hashes matched" % replay.checked)
+    if options.profile:
+        profiler.dump(options.profile)
+    return replay.diverged is None
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int,
+        help="world seed (random if omitted)")
+    parser.add_argument("--headless", type=int, metavar="FRAMES",
+        help="run FRAMES frames without a terminal and report the tick rate")
+    parser.add_argument("--profile", metavar="FILE",
+        help="profile from the start and write the results to FILE on exit")
+    parser.add_argument("--population", action="store_true",
+        help="keep monsters in an array-backed Population")
+    parser.add_argument("--chunked", action="store_true",
+        help="unbounded world, generated in chunks as it is explored")
+    parser.add_argument("--load", metavar="FILE",
+        help="restore the world saved in FILE instead of making a new one")
+    parser.add_argument("--save", metavar="FILE",
+        help="save the world to FILE on exit (and every --autosave seconds)")
+    parser.add_argument("--autosave", type=float, default=30.0,
+        metavar="SECONDS", help="time between saves with --save")
+    parser.add_argument("--record", metavar="FILE",
+        help="log the seed and every input to FILE, to be replayed")
+    parser.add_argument("--replay", metavar="FILE",
+        help="play back the game logged in FILE with --record")
+    parser.add_argument("--fast", action="store_true",
+        help="with --replay: as fast as possible, without a terminal")
+    parser.add_argument("--staged", action="store_true",
+        help="with --headless: generate the map in the background, like "
+        "the game does")
+    parser.add_argument("--memory", action="store_true",
+        help="with --headless: report the memory used by each part of the "
+        "world")
+    parser.add_argument("--render", action="store_true",
+        help="with --headless: render every frame to an off-screen 80x24 "
+        "window and report what the screen diff sent")
+    parser.add_argument("--size", type=int, default=300,
+        help="map width and height, for --headless")
+    parser.add_argument("--rate", type=float, default=15.0,
+        help="simulation steps per second")
+    parser.add_argument("--render-rate", type=float, default=15.0,
+        help="most frames drawn per second")
+    options = parser.parse_args(argv)
+    if options.record and (options.load or options.replay):
+        parser.error("--record makes a new world")
+    if options.chunked and (options.save or options.load):
+        parser.error("--save and --load need a fixed-size world, "
+            "not --chunked")
+    if options.chunked and options.population:
+        parser.error("--population needs a fixed-size world, not --chunked")
+    return options
 
 if __name__=='__main__':
-    curses.wrapper(main)
-
+    options = parse_args(sys.argv[1:])
+    if options.replay and options.fast:
+        sys.exit(0 if fast_forward(options) else 1)
+    elif options.headless is not None:
+        headless(options.headless, options)
+    else:
+        curses.wrapper(main, options)
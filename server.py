@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+#
+# Multi-player server: one shared world, one simulation tick, any number of
+# players connected over TCP with a telnet client or a raw ANSI terminal.
+#
+#   python server.py [--port PORT] [--seed SEED]
+#       serve until interrupted, e.g. `telnet localhost 4000` to play
+#
+#   python server.py --bots N [--slow M] [--seconds S]
+#       load test: N simulated clients pressing random keys connect over
+#       localhost, M of them without ever reading what they are sent.
+#       Reports tick times, frames (sent, skipped, with nothing to draw,
+#       put off) and bytes sent.
+#
+# Each client gets its own camera and HUD drawn into its own Screen, so
+# only the cells that changed since its last frame are sent.  The world
+# tracks which cells changed in each tick (Map.take_changes): a client
+# whose camera and HUD stayed put only redraws the changed cells inside
+# its view, and isn't drawn at all if there are none.  Renders stop once
+# the tick has taken --share of the step interval; the clients left over
+# are drawn first on the next tick, along with the changes they missed,
+# so a burst of players moving at once delays some frames by a tick
+# instead of delaying the steps.  A client whose unsent output is over
+# --buffer bytes skips frames until it catches up (the next frame it gets
+# has every change since the last one it got); past --drop bytes it is
+# disconnected.  Writes never block the tick.
+
+import sys
+import time
+import random
+import socket
+import asyncio
+import argparse
+import collections
+
+from curse import KEYS, Scheduler, Screen, build_world, view_render, \
+    view_rect, view_visible, hud_render, hud_state
+
+# ANSI attributes of the color pairs set up by curse.init_colors
+PAIR_SGR = {
+    0: "0",
+    1: "0;30;47",
+    2: "0;32",
+    3: "0;32",
+    4: "0;37",
+    5: "0;32",
+    6: "0;31",
+    7: "0;33",
+    8: "0;31;47",
+    9: "0;31",
+    10: "0;37",
+    11: "0;31",
+    12: "0;33",
+}
+
+# cursor keys (ESC [ A...) -> commands
+ARROWS = {
+    ord('A'): 'up',
+    ord('B'): 'down',
+    ord('C'): 'right',
+    ord('D'): 'left',
+}
+
+# telnet: the server echoes (that is, nobody does) and no line mode
+TELNET_SETUP = b"\xff\xfb\x01\xff\xfb\x03"
+IAC, SB, SE, WILL = 255, 250, 240, 251
+
+class AnsiWindow:
+    # Window-like target for Screen.flush (and Screen.begin) that turns
+    # the calls into ANSI escape sequences, collected until take().
+    # Colors are curses color pair attributes, as Glyph.color gives them
+    # without curses (pair << 8).
+    def __init__(self, w=80, h=24):
+        self.size = (w, h)
+        self.out = []
+        self.sgr = None
+
+    def getmaxyx(self):
+        return (self.size[1], self.size[0])
+
+    def erase(self):
+        self.out.append("\x1b[0m\x1b[2J")
+        self.sgr = None
+
+    def box(self):
+        (w, h) = self.size
+        self.color(0)
+        line = "+" + "-" * (w - 2) + "+"
+        self.out.append("\x1b[1;1H" + line)
+        for y in range(2, h):
+            self.out.append("\x1b[%d;1H|\x1b[%d;%dH|" % (y, y, w))
+        self.out.append("\x1b[%d;1H%s" % (h, line))
+
+    def color(self, color):
+        sgr = PAIR_SGR.get((color >> 8) & 0xff, "0")
+        if sgr != self.sgr:
+            self.out.append("\x1b[%sm" % sgr)
+            self.sgr = sgr
+
+    def addstr(self, y, x, string, color=0):
+        self.color(color)
+        self.out.append("\x1b[%d;%dH%s" % (y + 1, x + 1, string))
+
+    # the output so far, as bytes
+    def take(self):
+        data = "".join(self.out).encode("utf-8")
+        del self.out[:]
+        return data
+
+class Client:
+    # A connected player: input parsing, a command queue for the next tick
+    # and rendering of its own view.
+    def __init__(self, server, writer, name):
+        self.server = server
+        self.writer = writer
+        self.player = server.sim.add_player(name)
+        self.screen = Screen()
+        self.window = AnsiWindow()
+        self.commands = collections.deque(maxlen=8) # extra keys are dropped
+        self.state = None # of the telnet/escape sequence parser
+        self.closed = False
+        self.shown = None # (camera, HUD) of the frame last sent
+        self.missed = [] # world changes of the renders put off since
+
+        # stats
+        self.frames = 0
+        self.skipped = 0
+        self.unchanged = 0 # frames with nothing to draw
+        self.sent = 0
+
+    # parse input bytes into commands, skipping telnet negotiation
+    def feed(self, data):
+        for c in data:
+            state = self.state
+            if state == "iac":
+                if c == SB:
+                    self.state = "sb"
+                elif c >= WILL:
+                    self.state = "option"
+                else:
+                    self.state = None
+            elif state == "option":
+                self.state = None
+            elif state == "sb":
+                if c == IAC:
+                    self.state = "sb-iac"
+            elif state == "sb-iac":
+                self.state = None if c == SE else "sb"
+            elif state == "esc":
+                self.state = "csi" if c == ord('[') else None
+            elif state == "csi":
+                self.state = None
+                self.command(ARROWS.get(c))
+            elif c == IAC:
+                self.state = "iac"
+            elif c == 27:
+                self.state = "esc"
+            elif c == ord('q'):
+                self.close()
+            else:
+                self.command(KEYS.get(c))
+
+    def command(self, cmd):
+        if cmd:
+            self.commands.append(cmd)
+
+    # the server ran out of time for this render (see Server.tick), the
+    # next one draws changes too
+    def put_off(self, changes):
+        if len(self.missed) < 4:
+            self.missed.append(changes)
+        else:
+            self.shown = None # drawn whole anyway
+            self.missed = []
+
+    # send the changes since the last frame sent, unless the client is
+    # behind on reading.  changes are the world's since the last render
+    # (see Map.take_changes).
+    def render(self, changes):
+        missed = self.missed
+        self.missed = []
+        transport = self.writer.transport
+        if transport.is_closing():
+            return
+        buffered = transport.get_write_buffer_size()
+        if buffered > self.server.drop_limit:
+            self.close()
+            return
+        if buffered > self.server.buffer_limit:
+            # the changes are lost to it, the next frame is drawn whole
+            self.shown = None
+            self.skipped += 1
+            return
+        player = self.player
+        world = player.world
+        screen = self.screen
+        if screen.size != self.window.size:
+            self.shown = None
+        (camera, view) = view_rect(self.window, player)
+        (cx, cy) = (int(round(camera[0])), int(round(camera[1])))
+        shown = (cx, cy, hud_state(player))
+        cells = None
+        if shown == self.shown and world.grid is not None:
+            cells = []
+            for changed in missed + [changes]:
+                inside = world.changes_in(changed, cx, cy, cx + view[2],
+                    cy + view[3])
+                if inside is None:
+                    cells = None
+                    break
+                cells.extend(inside)
+        if cells is None:
+            screen.begin(self.window)
+            view_render(screen, player)
+            hud_render(screen, player)
+        elif cells:
+            screen.begin(self.window, keep=True)
+            world.render_cells(screen, camera, view,
+                view_visible(player, view), cells)
+            hud_render(screen, player) # over the map, as in a whole frame
+        else:
+            self.unchanged += 1
+            return
+        self.shown = shown
+        screen.flush(self.window)
+        data = self.window.take()
+        if data:
+            self.writer.write(data)
+            self.sent += len(data)
+        self.frames += 1
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+class Server:
+    # Runs the shared Simulation at a fixed rate and renders every client
+    # after the steps, see the top of the file.
+    def __init__(self, sim, rate=15.0, render_rate=15.0,
+            buffer_limit=64 * 1024, drop_limit=1024 * 1024,
+            socket_buffer=16 * 1024, share=0.75):
+        self.sim = sim
+        self.scheduler = Scheduler(rate, render_rate)
+        self.socket_buffer = socket_buffer
+        self.buffer_limit = buffer_limit
+        self.drop_limit = drop_limit
+        self.share = share # of a step interval a tick may take to render
+        self.clients = []
+        self.late = [] # clients whose render is left over to the next tick
+        self.deferred = 0 # renders left over, in all
+        self.joined = 0
+        self.version = None # world version last rendered
+        self.tick_times = [] # seconds per tick() that stepped or rendered
+        sim.world.track_changes()
+
+    async def handle(self, reader, writer):
+        self.joined += 1
+        client = Client(self, writer, "Player %d" % self.joined)
+        self.clients.append(client)
+        # keep the kernel's queue short too, so a slow client shows up in
+        # the write buffer instead of getting stale frames later
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                self.socket_buffer)
+        writer.write(TELNET_SETUP + b"\x1b[?25l") # hide the cursor
+        try:
+            while not client.closed:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                client.feed(data)
+        except ConnectionError:
+            pass
+        finally:
+            client.close()
+            self.clients.remove(client)
+            self.sim.remove_player(client.player)
+
+    # steps and renders due now
+    def tick(self):
+        sim = self.sim
+        scheduler = self.scheduler
+        t0 = time.perf_counter()
+        steps = scheduler.steps()
+        for i in range(steps):
+            for client in self.clients:
+                while client.commands:
+                    sim.command(client.commands.popleft(), client.player)
+            sim.step(scheduler.dt)
+            for client in self.clients:
+                if client.player.hp <= 0:
+                    sim.command("respawn", client.player)
+
+        if sim.world.version != self.version or self.late:
+            scheduler.dirty = True
+        rendered = scheduler.render_due()
+        if rendered:
+            self.version = sim.world.version
+            changes = sim.world.take_changes()
+            deadline = t0 + self.share * scheduler.dt
+            late = [c for c in self.late if c in self.clients]
+            clients = late + [c for c in self.clients if c not in late]
+            self.late = []
+            for (k, client) in enumerate(clients):
+                if k and time.perf_counter() > deadline:
+                    for client in clients[k:]:
+                        client.put_off(changes)
+                    self.late = clients[k:]
+                    self.deferred += len(self.late)
+                    break
+                client.render(changes)
+            scheduler.rendered()
+        if steps or rendered:
+            self.tick_times.append(time.perf_counter() - t0)
+
+    async def run(self):
+        while True:
+            self.tick()
+            await asyncio.sleep(self.scheduler.wait())
+
+async def bot(port, seconds, slow, received):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if slow:
+        # a small receive window, so what isn't read backs up on the server
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    sock.connect(("127.0.0.1", port))
+    sock.setblocking(False)
+    (reader, writer) = await asyncio.open_connection(sock=sock)
+    if slow:
+        writer.transport.pause_reading()
+
+    async def read():
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            received[0] += len(data)
+    reading = None if slow else asyncio.ensure_future(read())
+
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        writer.write(bytes([random.choice(b"ijkl ")]))
+        await asyncio.sleep(random.uniform(0.05, 0.2))
+    writer.close()
+    if reading:
+        reading.cancel()
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+async def loadtest(options):
+    server = Server(build_world(options.seed), buffer_limit=options.buffer,
+        drop_limit=options.drop, share=options.share)
+    server.sim.remove_player(server.sim.player)
+    tcp = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+    port = tcp.sockets[0].getsockname()[1]
+    running = asyncio.ensure_future(server.run())
+
+    received = [0]
+    bots = [bot(port, options.seconds, i < options.slow, received)
+        for i in range(options.bots)]
+    stats = {}
+    async def sample():
+        # client stats just before the bots leave
+        await asyncio.sleep(options.seconds - 0.2)
+        stats["clients"] = [(c.frames, c.skipped, c.sent, c.unchanged)
+            for c in server.clients]
+    await asyncio.gather(sample(), *bots)
+    await asyncio.sleep(0.2)
+    running.cancel()
+    tcp.close()
+
+    times = [t * 1000.0 for t in server.tick_times]
+    clients = stats["clients"]
+    frames = sum(c[0] for c in clients)
+    print("%d clients (%d not reading) for %.0fs" % (options.bots,
+        options.slow, options.seconds))
+    print("ticks: %d, ms p50 %.2f p99 %.2f max %.2f (budget %.1f)" % (
+        len(times), percentile(times, 50), percentile(times, 99),
+        max(times or [0.0]), server.scheduler.dt * 1000.0))
+    print("steps dropped: %d, renders put off to the next tick: %d" % (
+        server.scheduler.skipped, server.deferred))
+    print("frames sent: %d, skipped: %d, unchanged: %d, %.0f bytes per "
+        "frame" % (frames, sum(c[1] for c in clients),
+        sum(c[3] for c in clients), sum(c[2] for c in clients) /
+        max(frames, 1)))
+    print("bytes received by reading bots: %d" % received[0])
+
+async def serve(options):
+    sim = build_world(options.seed)
+    sim.remove_player(sim.player)
+    server = Server(sim, buffer_limit=options.buffer, drop_limit=options.drop,
+        share=options.share)
+    tcp = await asyncio.start_server(server.handle, options.host,
+        options.port)
+    print("serving on %s:%d" % (options.host, options.port))
+    async with tcp:
+        await server.run()
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=4000)
+    parser.add_argument("--seed", type=int,
+        help="world seed (random if omitted)")
+    parser.add_argument("--buffer", type=int, default=64 * 1024,
+        help="unsent bytes at which a client starts skipping frames")
+    parser.add_argument("--drop", type=int, default=1024 * 1024,
+        help="unsent bytes at which a client is disconnected")
+    parser.add_argument("--share", type=float, default=0.75,
+        help="part of a step interval after which a tick puts off the "
+        "renders left")
+    parser.add_argument("--bots", type=int,
+        help="run a load test with this many clients instead of serving")
+    parser.add_argument("--slow", type=int, default=0,
+        help="load test clients that never read")
+    parser.add_argument("--seconds", type=float, default=10.0,
+        help="load test length")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv[1:])
+    try:
+        if options.bots:
+            asyncio.run(loadtest(options))
+        else:
+            asyncio.run(serve(options))
+    except KeyboardInterrupt:
+        pass
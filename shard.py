@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+#
+# Sharded simulation: the map is split into vertical strips (regions),
+# each simulated by its own worker process, so the object loop uses as
+# many cores as there are workers.
+#
+#   python shard.py bench [--size N] [--density D] [--workers 1 2 4 ...]
+#       scaling benchmark: ticks/sec of the whole (un-culled) world in one
+#       process and with each number of workers.  Workers only run in
+#       parallel on separate cores: the speedup can't exceed the cpu
+#       count, and with fewer cpus than workers it is below 1x (e.g.
+#       0.95x, 0.62x, 0.85x for 1, 2, 4 workers at --size 600 on 1 cpu).
+#
+#   python shard.py play [--workers N] [--seed SEED]
+#       play in a terminal with the world sharded
+#
+# Every worker builds the same world from the seed (generation is
+# deterministic) and keeps only the objects in its region.  Tiles never
+# change, so each has the whole grid.  A tick is a barrier: the
+# coordinator sends every worker the tick, the player's commands and the
+# objects arriving in its region, and gets back the objects that left it.
+# Those are handed off to their new region on the next tick, where they
+# make contact with whatever is in the cell they arrived in, so a
+# try_move across a border collides one tick late but isn't lost.  For
+# rendering, the workers send the objects around the player, which are
+# drawn over the coordinator's copy of the tiles.
+
+import sys
+import time
+import bisect
+import argparse
+import multiprocessing
+
+from curse import Glyph, Player, Monster, Screen, Scheduler, KEYS, \
+    build_world, object_classes, draw, color_pair, init_colors, curses
+
+# the world of a shard: the forest, with extra monsters for a density
+# above the usual 0.01 per cell
+def build(seed, size, density):
+    sim = build_world(seed, size, size)
+    world = sim.world
+    if density > 0.01:
+        monster = world.glyph('monster')
+        world.sprinkle(
+            lambda **kwargs: Monster("monster", monster, world,
+                speed=world.random.random()*2.0, **kwargs),
+            density - 0.01
+        )
+    return sim
+
+# attributes not sent along with a handed off object
+LOCAL = ("world", "glyph", "pool", "cell_index", "alarm", "__weakref__")
+
+# names of the attributes of instances of cls (all in __slots__)
+def fields(cls):
+    return [name for c in cls.__mro__ for name in getattr(c, "__slots__", ())
+        if name not in LOCAL]
+
+# (class, name, glyph name, other attributes) of obj
+def pack(obj):
+    state = dict((k, getattr(obj, k)) for k in fields(obj.__class__)
+        if hasattr(obj, k))
+    return (obj.__class__.__name__, obj.name, obj.glyph.name, state)
+
+def unpack(world, record):
+    (cls, name, glyph, state) = record
+    obj = object_classes[cls](name, world.glyph(glyph), world,
+        pos=(state["x"], state["y"]), vel=(state["vx"], state["vy"]))
+    for (k, v) in state.items():
+        setattr(obj, k, v)
+    return obj
+
+class Region:
+    # The objects in columns x0 <= x < x1 of a shard's world
+    def __init__(self, sim, x0, x1):
+        self.sim = sim
+        self.world = sim.world
+        self.x0 = x0
+        self.x1 = x1
+        self.player = None
+        world = self.world
+        for obj in list(world.objects) + [sim.player]:
+            if self.inside(obj):
+                if isinstance(obj, Player):
+                    self.player = obj
+            else:
+                obj.detach()
+        world.prune()
+        # everything in the region is simulated, from its middle
+        self.center = ((x0 + x1) / 2.0, world.h / 2.0)
+        self.radius = max(x1 - x0, world.h)
+
+    def inside(self, obj):
+        return self.x0 <= int(round(obj.x)) < self.x1
+
+    def arrive(self, records):
+        world = self.world
+        for record in records:
+            obj = unpack(world, record)
+            if isinstance(obj, Player):
+                # the same player as a new object: monsters hunt this one
+                sim = self.sim
+                world.flow_field.retarget(sim.player, obj)
+                sim.players[sim.players.index(sim.player)] = obj
+                self.player = sim.player = obj
+            else:
+                world.ensure_object(obj)
+            obj.attach()
+            world.contact(obj, obj.x, obj.y)
+
+    # advance by t seconds, returns the records of the objects that left
+    def tick(self, t, commands):
+        sim = self.sim
+        world = self.world
+        if self.player:
+            for cmd in commands:
+                sim.command(cmd, self.player)
+        world.prune()
+        world.simulate(t, [self.center], self.radius)
+        # whatever left is in a chunk reaching past the region's edges
+        leaving = []
+        cs = world.chunk_size
+        for (key, chunk) in list(world.chunks.items()):
+            if self.x0 <= key[0] * cs and (key[0] + 1) * cs <= self.x1:
+                continue
+            for obj in list(chunk):
+                if not self.inside(obj):
+                    leaving.append(pack(obj))
+                    obj.detach()
+                    if obj is self.player:
+                        self.player = None
+        return leaving
+
+    # (x, y, glyph string, color pair) of the first object in each
+    # occupied cell of the rectangle
+    def view(self, x0, y0, w, h):
+        world = self.world
+        r = {}
+        for obj in world.objects_in(max(x0, self.x0), y0,
+                min(x0 + w, self.x1) - 1, y0 + h - 1):
+            cell = world.cells[obj.cell_index]
+            (x, y) = (int(round(obj.x)), int(round(obj.y)))
+            if not cell.tile.conceal and (x, y) not in r:
+                for first in cell.objects:
+                    r[(x, y)] = (x, y, first.glyph.string, first.glyph.pair)
+                    break
+        return list(r.values())
+
+    def status(self):
+        p = self.player
+        if not p:
+            return None
+        return {"x": p.x, "y": p.y, "hp": p.hp, "gold": p.gold,
+            "dir": p.dir, "thinking": p.thinking()}
+
+def worker(conn, seed, size, density, x0, x1):
+    region = Region(build(seed, size, density), x0, x1)
+    conn.send(len(region.world.objects))
+    while True:
+        msg = conn.recv()
+        if msg[0] == "tick":
+            (_, t, commands, arrivals) = msg
+            region.arrive(arrivals)
+            leaving = region.tick(t, commands)
+            conn.send((leaving, region.status(), len(region.world.objects)))
+        elif msg[0] == "view":
+            conn.send(region.view(*msg[1:]))
+        elif msg[0] == "stop":
+            break
+
+class ShardedSimulation:
+    # The coordinator: starts one worker per region and runs the ticks.
+    # player is the last status of the player (see Region.status).
+    def __init__(self, seed, size=300, density=0.01, workers=2):
+        self.size = size
+        self.bounds = [size * i // workers for i in range(1, workers)]
+        self.conns = []
+        self.processes = []
+        x0 = 0
+        for x1 in self.bounds + [size]:
+            (conn, child) = multiprocessing.Pipe()
+            p = multiprocessing.Process(target=worker,
+                args=(child, seed, size, density, x0, x1))
+            p.daemon = True
+            p.start()
+            self.conns.append(conn)
+            self.processes.append(p)
+            x0 = x1
+        self.objects = sum(conn.recv() for conn in self.conns)
+
+        # the tiles, for drawing; its objects are the workers' business
+        self.sim = build_world(seed, size, size)
+        self.world = self.sim.world
+        for obj in list(self.world.objects) + [self.sim.player]:
+            obj.detach()
+        self.world.prune()
+        p = self.sim.player
+        self.player = {"x": p.x, "y": p.y, "hp": p.hp, "gold": p.gold,
+            "dir": p.dir, "thinking": ""}
+        self.arrivals = [[] for conn in self.conns]
+        self.handoffs = 0
+        self.frame = 0
+        self.glyphs = {} # (string, pair) -> Glyph, for render
+
+    # index of the region holding column x
+    def region(self, x):
+        return bisect.bisect_right(self.bounds, int(round(x)))
+
+    def step(self, t, commands=()):
+        for (conn, arrivals) in zip(self.conns, self.arrivals):
+            conn.send(("tick", t, list(commands), arrivals))
+        self.arrivals = [[] for conn in self.conns]
+        self.objects = 0
+        for conn in self.conns:
+            (leaving, status, objects) = conn.recv()
+            self.objects += objects
+            if status:
+                self.player = status
+            for record in leaving:
+                self.arrivals[self.region(record[3]["x"])].append(record)
+                self.handoffs += 1
+        self.frame += 1
+
+    def over(self):
+        if self.player["hp"] <= 0:
+            return "You are dead."
+        return ""
+
+    # the map around the player and the HUD, like view_render/hud_render
+    def render(self, win):
+        (w, h) = win.getmaxyx()[::-1]
+        view = [1, 1, min(60, w - 2), min(20, h - 3)]
+        view[0] += w // 2 - view[2] // 2
+        view[1] += h // 2 - view[3] // 2
+        camera = (int(round(self.player["x"])) - view[2] // 2,
+            int(round(self.player["y"])) - view[3] // 2)
+        self.world.render(win, camera, view)
+        for conn in self.conns:
+            conn.send(("view", camera[0], camera[1], view[2], view[3]))
+        for conn in self.conns:
+            for (x, y, string, pair) in conn.recv():
+                glyph = self.glyphs.get((string, pair))
+                if not glyph:
+                    glyph = self.glyphs[(string, pair)] = \
+                        Glyph(string, string, pair)
+                draw(win, glyph, x - camera[0] + view[0],
+                    y - camera[1] + view[1])
+        status = "Gold: %s | HP %s / 100" % (self.player["gold"],
+            self.player["hp"])
+        thinking = self.player["thinking"]
+        if thinking:
+            win.addstr(2, 1 + w // 2 - len(thinking) // 2,
+                " %s " % thinking, color_pair(11))
+        win.addstr(h - 2, 1, self.world.name)
+        win.addstr(h - 2, w - len(status) - 1, status)
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(("stop",))
+        for p in self.processes:
+            p.join()
+
+# ticks per second of sim.step over at least min_time seconds
+def rate(step, min_time):
+    ticks = 0
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < min_time or ticks < 3:
+        step(1.0 / 15.0)
+        ticks += 1
+    return ticks / (time.perf_counter() - t0)
+
+def bench(options):
+    cpus = multiprocessing.cpu_count()
+    print("%dx%d cells, monster density %g, %d cpus" % (options.size,
+        options.size, options.density, cpus))
+    if max(options.workers) > cpus:
+        print("note: more workers than cpus, they share %d core%s, so "
+            "the speedup is bounded by %d (and the handoffs make it "
+            "slower)" % (cpus, "s" if cpus > 1 else "", cpus))
+    sim = build(options.seed, options.size, options.density)
+    sim.radius = options.size # nothing sleeps
+    base = rate(sim.step, options.time)
+    print("%-10s %8d objects %10.1f ticks/s" % ("1 process",
+        len(sim.world.objects), base))
+    for n in options.workers:
+        sharded = ShardedSimulation(options.seed, options.size,
+            options.density, n)
+        try:
+            r = rate(sharded.step, options.time)
+        finally:
+            sharded.close()
+        print("%-10s %8d objects %10.1f ticks/s %6.2fx, %d handoffs" % (
+            "%d workers" % n, sharded.objects, r, r / base,
+            sharded.handoffs))
+
+def play(win, options):
+    curses.curs_set(0)
+    init_colors()
+    sharded = ShardedSimulation(options.seed, options.size, options.density,
+        options.workers[0])
+    screen = Screen()
+    scheduler = Scheduler()
+    commands = []
+    try:
+        while not sharded.over():
+            for i in range(scheduler.steps()):
+                sharded.step(scheduler.dt, commands)
+                commands = []
+                scheduler.dirty = True
+            if scheduler.render_due():
+                screen.begin(win)
+                sharded.render(screen)
+                screen.flush(win)
+                win.refresh()
+                scheduler.rendered()
+            win.timeout(int(scheduler.wait() * 1000.0) + 1)
+            ch = win.getch()
+            if ch == ord('q'):
+                break
+            if ch in KEYS:
+                commands.append(KEYS[ch])
+    finally:
+        sharded.close()
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["bench", "play"])
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--size", type=int)
+    parser.add_argument("--density", type=float)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--time", type=float, default=2.0,
+        help="seconds to run each configuration, for bench")
+    options = parser.parse_args(argv)
+    if options.command == "bench":
+        options.size = options.size or 1000
+        options.density = options.density or 0.05
+        bench(options)
+    else:
+        options.size = options.size or 300
+        options.density = options.density or 0.01
+        curses.wrapper(play, options)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
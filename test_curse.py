@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+#
+# Regression tests, run with `python -m unittest` (standard library only).
+
+import os
+import tempfile
+import unittest
+
+import curse
+
+class ChunkedMapTest(unittest.TestCase):
+    def test_enter_generating_chunk(self):
+        # a bullet entering an ungenerated chunk generates it, which puts
+        # a monster in the same cell: both stay in it
+        sim = curse.build_world(4, chunked=True)
+        world = sim.world
+        i = (992, 998)
+        self.assertNotIn(world.chunk_key(i), world.resident)
+        bullet = world.spawn("bullet", pos=(992.0, 998.0), vel=(1.0, 0.0))
+        others = [obj for obj in world.cells[i].objects if obj is not bullet]
+        self.assertTrue(others)
+        for obj in others:
+            obj.detach()
+        bullet.detach()
+        self.assertNotIn(i, world.cells)
+
+    def test_evicted_objects_come_back(self):
+        sim = curse.build_world(4, chunked=True)
+        world = sim.world
+        key = world.chunk_key((992, 998))
+        world.chunk(key)
+        def objects():
+            return sorted((obj.__class__.__name__, obj.x, obj.y)
+                for obj in world.chunks.get(key, ()))
+        before = objects()
+        self.assertTrue(before)
+        world.capacity = 2
+        for k in range(4):
+            world.chunk((key[0] + 10 + k, key[1]))
+        self.assertNotIn(key, world.resident)
+        self.assertNotIn(key, world.chunks)
+        self.assertIsInstance(world.sleeping[key][1], bytes)
+        world.chunk(key)
+        self.assertEqual(objects(), before)
+
+    def test_teleporting_across_chunks(self):
+        sim = curse.build_world(4, chunked=True)
+        world = sim.world
+        world.capacity = 32
+        player = sim.player
+        for k in range(200):
+            player.teleport(player.x + 16, player.y + 16 * (k % 2))
+            sim.step(1.0 / 15.0)
+        self.assertLessEqual(len(world.resident), 32)
+        self.assertLessEqual(len(world.chunk_time), 32)
+        for obj in list(world.objects):
+            obj.detach()
+
+class RuledMapTest(unittest.TestCase):
+    def test_chunked_and_staged_agree(self):
+        # both generators replay the same rules the same way
+        chunked = curse.build_world(4, chunked=True).world
+        staged = curse.build_world(4, staged=True).world
+        key = (2, 3)
+        cs = chunked.chunk_size
+        tiles = chunked.chunk(key)
+        staged.prepare(key)
+        (x0, y0) = (key[0] * cs, key[1] * cs)
+        self.assertEqual([chunked.tiles[t].glyph.name for t in tiles],
+            [staged.terrain(staged.index(x0 + j % cs, y0 + j // cs))
+                .glyph.name for j in range(cs * cs)])
+        def objects(world):
+            return sorted((obj.name, obj.x, obj.y)
+                for obj in world.chunks.get(key, ()))
+        self.assertTrue(objects(chunked))
+        self.assertEqual(objects(chunked), objects(staged))
+
+class TimerWheelTest(unittest.TestCase):
+    def test_cancel_in_callback(self):
+        # two alarms due at the same tick, the first cancels the second
+        wheel = curse.TimerWheel()
+        fired = []
+        second = curse.Alarm(0.5, lambda: fired.append("second"))
+        def first_fired():
+            fired.append("first")
+            second.cancel()
+        first = curse.Alarm(0.5, first_fired)
+        wheel.add(first, 0.0)
+        wheel.add(second, 0.0)
+        wheel.advance(1.0)
+        self.assertEqual(fired, ["first"])
+        self.assertEqual(wheel.pending(), 0)
+
+    def test_add_again_in_callback(self):
+        # an alarm added again by another one of its batch waits its turn
+        wheel = curse.TimerWheel()
+        fired = []
+        second = curse.Alarm(0.5, lambda: fired.append("second"))
+        def first_fired():
+            fired.append("first")
+            second.cancel()
+            wheel.add(second, 0.5)
+        wheel.add(curse.Alarm(0.5, first_fired), 0.0)
+        wheel.add(second, 0.0)
+        wheel.advance(0.5)
+        self.assertEqual(fired, ["first"])
+        wheel.advance(1.0)
+        self.assertEqual(fired, ["first", "second"])
+
+class SnapshotTest(unittest.TestCase):
+    def test_save_mid_swing(self):
+        # a sword saved between frames keeps its frame and alarm phase
+        path = os.path.join(tempfile.mkdtemp(), "swing.snap")
+        sim = curse.build_world(1)
+        for k in range(5):
+            sim.step(1.0 / 15.0)
+        sim.step(1.0 / 15.0, ["swing"])
+        sim.step(1.0 / 30.0)
+        curse.save_world(sim, path)
+        loaded = curse.load_world(path)
+        def swords(sim):
+            return sorted((obj.x, obj.y, obj.frame, obj.glyph.string)
+                for obj in sim.world.objects
+                if isinstance(obj, curse.Sword) and obj.attached())
+        self.assertTrue(swords(sim))
+        for k in range(12):
+            self.assertEqual(swords(loaded), swords(sim))
+            self.assertEqual(curse.state_hash(loaded), curse.state_hash(sim))
+            sim.step(1.0 / 15.0)
+            loaded.step(1.0 / 15.0)
+
+if __name__ == '__main__':
+    unittest.main()